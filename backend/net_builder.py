@@ -24,7 +24,8 @@ class FinalLayer(Enum):
 
 
 class NetBuilder:
-    def __init__(self):
+    def __init__(self, input_size=(224, 224)):
+        self.input_size = tuple(input_size)  # (h, w) the input pipeline should produce
         self.input_node = None
         self.is_train_node = None
         self.arch = None
@@ -0,0 +1,194 @@
+import glob
+import os
+import re
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import pipeline
+import utils
+
+SAMPLES = 5000
+BATCH_SIZE = 32
+# build each one with image2tfrecord.gen_train_tfrecord(record_format=..., output_dir=...)
+FORMATS = {
+    'jpeg': os.path.join('tfrecord', 'train-*-of-*.tfrecord'),
+    'raw': os.path.join('tfrecord', 'raw', 'train-*-of-*.tfrecord'),
+    'npy': os.path.join('tfrecord', 'npy', 'train-*-of-*.npy'),
+}
+# build each one with image2tfrecord.gen_train_tfrecord(compression=..., output_dir=...)
+CODECS = {
+    '': os.path.join('tfrecord', 'train-*-of-*.tfrecord'),
+    'GZIP': os.path.join('tfrecord', 'gzip', 'train-*-of-*.tfrecord'),
+    'ZLIB': os.path.join('tfrecord', 'zlib', 'train-*-of-*.tfrecord'),
+}
+
+
+def dataset_throughput(data_set, samples=SAMPLES):
+    with tf.Session() as sess:
+        next_element = data_set.batch(BATCH_SIZE).make_one_shot_iterator().get_next()
+        sess.run(next_element)  # warm up
+        count = 0
+        start = time.time()
+        try:
+            while count < samples:
+                images, _ = sess.run(next_element)
+                count += images.shape[0]
+        except tf.errors.OutOfRangeError:
+            pass
+        return count / (time.time() - start)
+
+
+def record_throughput(data_set, samples=SAMPLES):
+    with tf.Session() as sess:
+        next_element = data_set.batch(BATCH_SIZE).make_one_shot_iterator().get_next()
+        count = 0
+        start = time.time()
+        try:
+            while count < samples:
+                count += sess.run(next_element).shape[0]
+        except tf.errors.OutOfRangeError:
+            pass
+        return count / (time.time() - start)
+
+
+def augment_throughput(batched, samples=SAMPLES):
+    # synthetic decoded images, so only the augmentation cost is measured
+    img = tf.constant(np.random.randint(0, 256, utils.IMAGE_SHAPE, dtype=np.uint8))
+    data_set = tf.data.Dataset.from_tensors((img, tf.constant(0, tf.int64))).repeat(samples + BATCH_SIZE)
+    if batched:
+        data_set = pipeline.map_pipeline(data_set, None, BATCH_SIZE,
+                                         batch_map_fn=pipeline.augment_batch_function)
+    else:
+        data_set = pipeline.map_pipeline(data_set, utils.augment_function, BATCH_SIZE)
+    with tf.Session() as sess:
+        next_element = data_set.make_one_shot_iterator().get_next()
+        sess.run(next_element)  # warm up
+        count = 0
+        start = time.time()
+        while count < samples:
+            images, _ = sess.run(next_element)
+            count += images.shape[0]
+        return count / (time.time() - start)
+
+
+def augment_report():
+    rates = {}
+    for name, batched in (('per-element', False), ('batched', True)):
+        with tf.Graph().as_default(), tf.device('/cpu:0'):
+            rates[name] = augment_throughput(batched)
+        print('%-12s %8.1f img/s' % (name, rates[name]))
+    print('batched augmentation: %.2fx' % (rates['batched'] / rates['per-element']))
+
+
+def feed_throughput(iterator_input, samples=SAMPLES):
+    # train.py's two ways of getting a batch into the net, a 1x1 conv stands in for the model
+    images = tf.random.uniform((BATCH_SIZE,) + utils.IMAGE_SHAPE)
+    data_set = tf.data.Dataset.from_tensors(images).repeat()
+    next_element = data_set.make_one_shot_iterator().get_next()
+    if iterator_input:
+        input_layer = tf.placeholder_with_default(next_element, (None,) + utils.IMAGE_SHAPE, name='input_images')
+    else:
+        input_layer = tf.placeholder(tf.float32, (None,) + utils.IMAGE_SHAPE, name='input_images')
+    net = tf.reduce_mean(tf.layers.conv2d(input_layer, 8, 1))
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        count = 0
+        start = None
+        while count < samples:
+            if iterator_input:
+                sess.run(net)
+            else:
+                sess.run(net, feed_dict={input_layer: sess.run(next_element)})
+            if start is None:
+                start = time.time()  # first step is warm up
+            else:
+                count += BATCH_SIZE
+        return count / (time.time() - start)
+
+
+def feed_report():
+    rates = {}
+    for name, iterator_input in (('feed_dict', False), ('iterator', True)):
+        with tf.Graph().as_default():
+            rates[name] = feed_throughput(iterator_input)
+        print('%-10s %8.1f img/s' % (name, rates[name]))
+    print('iterator input: %.2fx the feed_dict rate' % (rates['iterator'] / rates['feed_dict']))
+
+
+def time_to_accuracy_report(log_files=None, target=0.95):
+    # compares train.py runs from their logs, e.g. a RESOLUTION_SCHEDULE run against a fixed INPUT_SIZE one
+    print('run                          schedule                      min to %.3f  best acc' % target)
+    for path in sorted(log_files or glob.glob(os.path.join('log', '*.log'))):
+        schedule = '?'
+        reached = None
+        best = 0.0
+        with open(path) as f:
+            for line in f:
+                match = re.search(r'resolution schedule: (.*)$', line)
+                if match:
+                    schedule = match.group(1)
+                match = re.search(r'validation at step \d+ after ([\d.]+) min: accuracy ([\d.]+)', line)
+                if match:
+                    minutes, accuracy = float(match.group(1)), float(match.group(2))
+                    best = max(best, accuracy)
+                    if reached is None and target <= accuracy:
+                        reached = minutes
+        print('%-28s %-30s %11s %9.4f' % (os.path.basename(path), schedule[:30],
+                                          '-' if reached is None else '%.1f' % reached, best))
+
+
+def count_samples(record_format, files):
+    if record_format == 'npy':
+        return sum(np.load(f, mmap_mode='r').shape[0] for f in files)
+    return sum(1 for f in files for _ in utils.record_iterator(f))
+
+
+def record_format_report():
+    print('format   size(MB)   KB/img    img/s  MB/s read')
+    rows = []
+    for record_format, pattern in FORMATS.items():
+        files = sorted(glob.glob(pattern))
+        if not files:
+            print('%-6s no records at %s' % (record_format, pattern))
+            continue
+        size = sum(os.path.getsize(f) for f in files)
+        bytes_per_img = size / count_samples(record_format, files)
+        with tf.Graph().as_default():
+            rate = dataset_throughput(utils.train_dataset(pattern, record_format))
+        rows.append((record_format, rate, rate * bytes_per_img / 2 ** 20))
+        print('%-6s %10.1f %8.1f %8.1f %10.1f' %
+              (record_format, size / 2 ** 20, bytes_per_img / 1024, rate, rate * bytes_per_img / 2 ** 20))
+
+    # a bigger format only pays off if the storage can keep up with the bandwidth it needs
+    for record_format, rate, bandwidth in rows:
+        print('%s: %.1f img/s as long as storage sustains %.1f MB/s' % (record_format, rate, bandwidth))
+
+
+def compression_report():
+    print('codec    size(MB)   records/s      img/s')
+    baseline = None
+    for compression, pattern in CODECS.items():
+        files = sorted(glob.glob(pattern))
+        if not files:
+            print('%-6s no records at %s' % (compression or 'NONE', pattern))
+            continue
+        size = sum(os.path.getsize(f) for f in files)
+        with tf.Graph().as_default():
+            read_rate = record_throughput(utils.record_dataset(pattern))
+        with tf.Graph().as_default():
+            parse_rate = dataset_throughput(utils.train_dataset(pattern))
+        if baseline is None and compression == '':
+            baseline = read_rate
+        print('%-6s %10.1f %11.1f %10.1f' % (compression or 'NONE', size / 2 ** 20, read_rate, parse_rate))
+        if baseline:
+            print('       %.2fx the uncompressed read rate' % (read_rate / baseline))
+
+
+if __name__ == '__main__':
+    record_format_report()
+    # compression_report()
+    # augment_report()
+    # feed_report()
+    # time_to_accuracy_report()
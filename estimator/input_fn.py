@@ -1,16 +1,16 @@
 import os
 import tensorflow as tf
 
-import utils
+import pipeline
 
 
 def train_input_fn(tfrecord_name, params):
     record_path = os.path.join('tfrecord', tfrecord_name)
-    data_set = tf.data.TFRecordDataset(record_path)
-    data_set = data_set.map(utils.parse_function)
-    data_set = data_set.shuffle(buffer_size=params.buffer_size)
-    data_set = data_set.batch(params.batch_size, drop_remainder=True)
-    data_set = data_set.repeat()
+    data_set = pipeline.train_pipeline(record_path, params.batch_size,
+                                       shuffle_buffer=params.buffer_size,
+                                       repeat=True,
+                                       drop_remainder=True,
+                                       num_parallel_calls=params.num_parallel_calls)
 
     iterator = data_set.make_one_shot_iterator()
     images_train, labels_train = iterator.get_next()
@@ -19,9 +19,9 @@ def train_input_fn(tfrecord_name, params):
 
 def test_input_fn(tfrecord_name, params):
     record_path = os.path.join('tfrecord', tfrecord_name)
-    data_set = tf.data.TFRecordDataset(record_path)
-    data_set = data_set.map(utils.parse_function)
-    data_set = data_set.batch(params.batch_size, drop_remainder=True)
+    data_set = pipeline.train_pipeline(record_path, params.batch_size,
+                                       drop_remainder=True,
+                                       num_parallel_calls=params.num_parallel_calls)
 
     iterator = data_set.make_one_shot_iterator()
     images_train, labels_train = iterator.get_next()
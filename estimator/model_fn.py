@@ -1,5 +1,6 @@
 import tensorflow as tf
 
+import pipeline
 from backend.net_builder import FinalLayer, NetBuilder, Arch
 from backend.loss_function import combine_loss_val
 
@@ -59,5 +60,6 @@ def model_fn(features, labels, mode, params):
     global_step = tf.train.get_global_step()
     with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
         train_op = optimizer.minimize(loss, global_step=global_step)
+    pipeline.input_ready(images)  # for pipeline.StepTimerHook
 
     return tf.estimator.EstimatorSpec(mode, loss=loss, train_op=train_op)
@@ -1,13 +1,16 @@
 import glob
+import hashlib
+import json
+import multiprocessing
 import random
 
 import cv2
 import os
-import pickle
-# import mxnet as mx
 import tensorflow as tf
 import numpy as np
 
+import utils
+
 KEY_IMAGE = 'image_raw'
 KEY_LABEL = 'label'
 KEY_TEXT = 'text'
@@ -16,107 +19,574 @@ KEY_IMAGE_FIRST = 'image_first'
 KEY_IMAGE_SECOND = 'image_second'
 KEY_FIRST_NAME = 'first_name'
 KEY_SECOND_NAME = 'second_name'
+KEY_FIRST_IDX = 'first_idx'
+KEY_SECOND_IDX = 'second_idx'
 IMAGE_SIZE = (224, 224)
 SAME_PER_PERSON = 20
+NUM_SHARDS = 64
+NUM_WORKERS = os.cpu_count()
+CHUNK_SIZE = 64
+MIN_SHARD_SIZE = 1024
+MANIFEST_NAME = 'train.manifest'
+DEDUPE = True  # hash the decoded, resized pixels to drop repeats within an identity and flag them across
+RECORD_FORMAT = 'jpeg'  # 'jpeg', 'raw' (uint8 HxWx3 bytes in the tfrecord) or 'npy' (memory-mappable shards)
+COMPRESSION = None  # None, 'GZIP' or 'ZLIB', readers pick it up from the '<record>.json' header
+LAYOUT = 'mixed'  # 'mixed' deals images round-robin, 'identity' gives each bucket of identities its own shard
+IDENTITIES_PER_SHARD = 1
+PASS_THROUGH = True  # copy source jpeg bytes untouched when they are already IMAGE_SIZE
+JPEG_QUALITY = 95
+JPEG_SAMPLING = None  # '444', '422', '420'... (needs opencv >= 4.5.5), None keeps libjpeg default 4:2:0
+# 'pair_index' writes one index record (first_idx, second_idx, is_same) and then every image once,
+# 'pair' repeats both jpegs inline in every pair record
+VER_FORMAT = 'pair_index'
+SOF_MARKERS = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
 
 
-def gen_train_tfrecord():
-    output_path = os.path.join('tfrecord', 'train.tfrecord')
-    writer = tf.python_io.TFRecordWriter(output_path)
-
+def gen_train_tfrecord(num_shards=NUM_SHARDS, num_workers=NUM_WORKERS, rebuild=False, record_format=RECORD_FORMAT,
+                       output_dir='tfrecord', compression=COMPRESSION, layout=LAYOUT,
+                       identities_per_shard=IDENTITIES_PER_SHARD):
     directory = os.path.join('images', 'image_db')
     faces = [
         o for o in os.listdir(directory) if os.path.isdir(os.path.join(directory, o))
     ]
     faces = {f: glob.glob(os.path.join(directory, f, '*.jpg')) for f in faces}
 
-    write_record(writer, faces)
-    writer.close()
+    # label ids come from the manifest so they never move, new classes are appended after them.
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    header, entries = load_manifest(manifest_path)
+    classes = header['classes'] + sorted(set(faces) - set(header['classes']))
+    labels = {name: i for i, name in enumerate(classes)}
+
+    if rebuild:
+        # every shard of earlier builds with its sidecars, including shards whose images have all been removed
+        # or changed since and which no manifest entry points at any more
+        for path in glob.glob(os.path.join(output_dir, 'train*-of-*.*')):
+            os.remove(path)
+        header['build'] = 0
+        entries = {}
+    settings = {'format': record_format, 'compression': compression or '', 'layout': layout}
+    defaults = {'format': 'jpeg', 'compression': '', 'layout': 'mixed'}  # manifests written before they were stored
+    for key, value in settings.items():
+        if entries and header.get(key, defaults[key]) != value:
+            raise ValueError('existing shards have %s \'%s\', use rebuild=True to switch to \'%s\''
+                             % (key, header.get(key, defaults[key]), value))
+    header.update(settings)
+
+    pending, stale = scan_changes(faces, entries)
+    present = set(path for paths in faces.values() for path in paths)
+    removed = [entry for path, entry in entries.items() if path not in present]
+    for entry in stale + removed:
+        del entries[entry['path']]
+    unknown = drop_records(stale + removed, entries)
+    if stale or removed:
+        print('dropped the records of %d changed and %d removed images' % (len(stale), len(removed)))
+    if unknown:
+        print('%d of them are in shards built before records were numbered, use rebuild=True to drop them' % unknown)
+
+    # a duplicate that was dropped in favour of an image that is gone now gets written after all
+    owners = set(entry['pixel'] for entry in entries.values() if entry['shard'])
+    orphans = [entry for entry in entries.values() if entry['shard'] is None and entry.get('pixel') not in owners]
+    for entry in orphans:
+        del entries[entry['path']]
+        pending.append((entry['path'], classes[entry['label']], entry['size'], entry['mtime']))
+
+    header['classes'] = classes
+    if pending:
+        prefix = 'train' if not entries else 'train-r%03d' % (header['build'] + 1)
+        header['build'] = header['build'] + 1 if entries else 0
+        num_shards = max(1, min(num_shards, len(pending) // MIN_SHARD_SIZE))
+        samples = [(path, labels[name], name.encode('utf8')) for path, name, _, _ in pending]
+        dedupe = Deduplicator({entry['pixel']: (entry['label'], entry['path'])
+                               for entry in entries.values() if entry.get('pixel') and entry['shard']})
+        results = write_sharded_record(os.path.join(output_dir, prefix), samples, num_shards, num_workers,
+                                       record_format, compression, dedupe, layout, identities_per_shard)
+        dedupe.report(os.path.join(output_dir, 'train.duplicates'))
+        for (path, name, size, mtime), (shard, record, sha1, pixel) in zip(pending, results):
+            entries[path] = {'path': path, 'size': size, 'mtime': mtime, 'sha1': sha1,
+                             'label': labels[name], 'shard': shard, 'record': record, 'pixel': pixel}
+    else:
+        print('no new or changed images')
+    save_manifest(manifest_path, header, entries)
+    print('num classes: %d, images in manifest: %d' % (len(classes), len(entries)))
+
+
+def scan_changes(faces, entries):
+    # a file is only re-read when size or mtime moved, and only re-encoded when its content did.
+    # returns the new or changed files and the manifest entries of the changed ones
+    pending = []
+    stale = []
+    for name, paths in faces.items():
+        for path in paths:
+            stat = os.stat(path)
+            entry = entries.get(path)
+            if entry is not None and (entry['size'], entry['mtime']) != (stat.st_size, stat.st_mtime):
+                if entry['sha1'] == file_sha1(path):
+                    entry['mtime'] = stat.st_mtime
+                else:
+                    stale.append(entry)
+                    entry = None
+            if entry is None:
+                pending.append((path, name, stat.st_size, stat.st_mtime))
+    return pending, stale
+
+
+def drop_records(dead, entries):
+    # rewrites every shard holding a record of the dead entries with only the records of the live entries
+    # and renumbers those. returns how many dead records could not be located, their shard has entries
+    # from manifests written before records were numbered
+    dead_records = {}
+    for entry in dead:
+        if entry.get('shard'):
+            dead_records.setdefault(entry['shard'], []).append(entry.get('record'))
+    live = {shard: [] for shard in dead_records}
+    for entry in entries.values():
+        if entry.get('shard') in live:
+            live[entry['shard']].append(entry)
+    unknown = 0
+    for shard, records in sorted(dead_records.items()):
+        if not os.path.exists(shard):
+            continue
+        if None in records or any(entry.get('record') is None for entry in live[shard]):
+            unknown += len(records)
+            continue
+        kept = sorted(live[shard], key=lambda entry: entry['record'])
+        rewrite_shard(shard, [entry['record'] for entry in kept])
+        for record, entry in enumerate(kept):
+            entry['record'] = record
+    return unknown
+
+
+def rewrite_shard(path, keep):
+    # keeps the records at the sorted positions keep, a shard left empty is removed with its sidecars
+    sidecars = ('.labels',) if path.endswith('.npy') else ('.json', '.index')
+    if not keep:
+        for name in (path,) + tuple(path + ext for ext in sidecars):
+            if os.path.exists(name):
+                os.remove(name)
+        return
+    tmp_path = path + '.tmp'
+    if path.endswith('.npy'):
+        images = np.load(path, mmap_mode='r')
+        labels = np.load(path + '.labels')
+        writer = NpyShardWriter(tmp_path, len(keep))
+        for k in keep:
+            writer.write(images[k], labels[k])
+        writer.close()
+        del images
+    else:
+        header = utils.record_header(path)
+        labels = np.load(path + '.index')[:, 2]
+        writer = RecordWriter(tmp_path, header.get('compression') or None, header.get('format', 'jpeg'))
+        keep = set(keep)
+        for k, record in enumerate(utils.record_iterator(path)):
+            if k in keep:
+                writer.write(record, labels[k])
+        writer.close()
+    for ext in ('',) + sidecars:
+        os.replace(tmp_path + ext, path + ext)
+
+
+def file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_manifest(path):
+    header = {'classes': [], 'build': 0}
+    entries = {}
+    if not os.path.exists(path):
+        return header, entries
+    with open(path) as f:
+        header.update(json.loads(f.readline()))
+        for line in f:
+            entry = json.loads(line)
+            entries[entry['path']] = entry
+    return header, entries
+
+
+def save_manifest(path, header, entries):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(header) + '\n')
+        for entry in entries.values():
+            f.write(json.dumps(entry) + '\n')
+    os.replace(tmp_path, path)
+
+
+def shard_path(prefix, index, num_shards, ext='tfrecord'):
+    return '%s-%05d-of-%05d.%s' % (prefix, index, num_shards, ext)
 
 
 def show_bin_image():
-    bins, issame_list = pickle.load(open(os.path.join('images', 'vgg2_fp.bin'), 'rb'), encoding='bytes')
-    for i in range(len(bins)):
-        img_info = bins[i]
-        img = mx.image.imdecode(img_info).asnumpy()
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    images, _ = utils.load_bin_arrays(os.path.join('images', 'vgg2_fp.bin'))
+    for img in images:
         cv2.imshow('frame', img)
         cv2.waitKey(0)
 
 
-def show_train_tfrecord_image():
-    input_path = os.path.join('tfrecord', 'train.tfrecord')
-    record_iterator = tf.python_io.tf_record_iterator(path=input_path)
-    for record in record_iterator:
-        example = tf.train.Example()
-        example.ParseFromString(record)
-        image_string = example.features.feature[KEY_IMAGE].bytes_list.value[0]
-        img = np.fromstring(image_string, dtype=np.uint8)
-        img = cv2.imdecode(img, cv2.IMREAD_COLOR)
-        label = example.features.feature[KEY_LABEL].int64_list.value[0]
-        text = example.features.feature[KEY_TEXT].bytes_list.value[0]
+def show_train_tfrecord_image(pattern=os.path.join('tfrecord', 'train-*-of-*.tfrecord')):
+    for input_path in sorted(glob.glob(pattern)):
+        show_record_image(input_path)
 
-        print(f'label:{label}, text:{text}')
-        cv2.imshow('frame', img)
-        cv2.waitKey(0)
 
+def show_indexed_image(pattern, k):
+    # jumps straight to record k through the '.index' sidecars instead of scanning the shards
+    show_record(utils.RecordIndex(pattern).read(k))
 
-def write_record(writer, faces):
-    for i, (k, paths) in enumerate(faces.items()):
-        text = k.encode('utf8')
-        label = i
-        for path in paths:
-            img = cv2.imread(path)
-            img = cv2.resize(img, IMAGE_SIZE)
-            img = cv2.imencode('.jpg', img)[1].tostring()
-            example = tf.train.Example(features=tf.train.Features(feature={
-                KEY_IMAGE: tf.train.Feature(bytes_list=tf.train.BytesList(value=[img])),
-                KEY_LABEL: tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
-                KEY_TEXT: tf.train.Feature(bytes_list=tf.train.BytesList(value=[text]))
-            }))
-            writer.write(example.SerializeToString())  # Serialize To String
-        if i % 10 == 0:
-            print('%d person processed' % i)
-
-
-def write_ver_record(writer, faces):
-    for i, (k, _) in enumerate(faces.items()):
-        same_pool = [path for (key, paths) in faces.items() if key == k for path in paths]
-        diff_pool = [path for (key, paths) in faces.items() if key != k for path in paths]
-
-        same_pairs = np.random.choice(same_pool, size=(len(same_pool)//2, 2), replace=False)
-        diff_face = np.random.choice(diff_pool, size=len(same_pool), replace=False)
-        diff_pairs = np.vstack((same_pool, list(diff_face))).transpose()
-
-        write_pair(same_pairs, writer, is_same=1)
-        write_pair(diff_pairs, writer, is_same=0)
-
-
-def write_pair(same_pairs, writer, is_same):
-    for same1, same2 in same_pairs:
-        print(f'{same1} vs {same2} is {is_same}')
-        img1 = cv2.imread(same1)
-        img1 = cv2.resize(img1, IMAGE_SIZE)
-        img1 = cv2.imencode('.jpg', img1)[1].tostring()
-        img2 = cv2.imread(same2)
-        img2 = cv2.resize(img2, IMAGE_SIZE)
-        img2 = cv2.imencode('.jpg', img2)[1].tostring()
-        first_name = same1.split('/')[-1].encode('utf8')
-        second_name = same2.split('/')[-1].encode('utf8')
-
-        example = tf.train.Example(features=tf.train.Features(feature={
-            KEY_IMAGE_FIRST: tf.train.Feature(bytes_list=tf.train.BytesList(value=[img1])),
-            KEY_IMAGE_SECOND: tf.train.Feature(bytes_list=tf.train.BytesList(value=[img2])),
-            KEY_FIRST_NAME: tf.train.Feature(bytes_list=tf.train.BytesList(value=[first_name])),
-            KEY_SECOND_NAME: tf.train.Feature(bytes_list=tf.train.BytesList(value=[second_name])),
-            KEY_IS_SAME: tf.train.Feature(int64_list=tf.train.Int64List(value=[is_same]))
-        }))
-        writer.write(example.SerializeToString())
-
-
-def gen_verification_tfrecord():
+
+def show_record_image(input_path):
+    for record in utils.record_iterator(input_path):
+        show_record(record)
+
+
+def show_record(record):
+    example = tf.train.Example()
+    example.ParseFromString(record)
+    image_string = example.features.feature[KEY_IMAGE].bytes_list.value[0]
+    img = np.fromstring(image_string, dtype=np.uint8)
+    img = cv2.imdecode(img, cv2.IMREAD_COLOR)
+    label = example.features.feature[KEY_LABEL].int64_list.value[0]
+    text = example.features.feature[KEY_TEXT].bytes_list.value[0]
+
+    print(f'label:{label}, text:{text}')
+    cv2.imshow('frame', img)
+    cv2.waitKey(0)
+
+
+def write_sharded_record(prefix, samples, num_shards, num_workers, record_format=RECORD_FORMAT,
+                         compression=COMPRESSION, dedupe=None, layout=LAYOUT, identities_per_shard=IDENTITIES_PER_SHARD):
+    # decode/resize/encode and the pixel hash run in the pool, each shard keeps its own writer.
+    # 'mixed' deals kept samples round-robin so every shard gets the same count (+-1),
+    # 'identity' sends every sample of a bucket of identities to that bucket's shard.
+    dedupe = dedupe or Deduplicator()
+    if layout == 'identity':
+        ordered = sorted(set(label for _, label, _ in samples))
+        buckets = {label: i // identities_per_shard for i, label in enumerate(ordered)}
+        num_shards = (len(ordered) + identities_per_shard - 1) // identities_per_shard
+        counts = np.bincount([buckets[label] for _, label, _ in samples], minlength=num_shards)
+    else:
+        buckets = None
+        counts = [len(samples[i::num_shards]) for i in range(num_shards)]
+    if record_format == 'npy':
+        shards = [shard_path(prefix, i, num_shards, 'npy') for i in range(num_shards)]
+        writers = [NpyShardWriter(shard, counts[i]) for i, shard in enumerate(shards)]
+    else:
+        shards = [shard_path(prefix, i, num_shards) for i in range(num_shards)]
+        writers = [RecordWriter(shard, compression, record_format) for shard in shards]
+    worker = encode_sample if record_format == 'jpeg' else raw_sample
+    results = []  # (shard, record, sha1, pixel) per sample, shard and record are None for dropped duplicates
+    written = 0
+    positions = [0] * num_shards
+
+    with multiprocessing.Pool(num_workers) as pool:
+        encoded = pool.imap(worker, [path for path, _, _ in samples], chunksize=CHUNK_SIZE)
+        for i, ((img, sha1, pixel), (path, label, text)) in enumerate(zip(encoded, samples)):
+            if not dedupe.keep(pixel, label, path, img.nbytes if record_format != 'jpeg' else len(img)):
+                results.append((None, None, sha1, pixel))
+                continue
+            shard = buckets[label] if buckets else written % num_shards
+            writer = writers[shard]
+            if record_format == 'npy':
+                writer.write(img, label)
+            elif record_format == 'raw':
+                writer.write(train_example(img.tobytes(), label, text), label)
+            else:
+                writer.write(train_example(img, label, text), label)
+            results.append((shards[shard], positions[shard], sha1, pixel))
+            positions[shard] += 1
+            written += 1
+            if i % 10000 == 0:
+                print('%d/%d images processed' % (i, len(samples)))
+
+    for writer in writers:
+        writer.close()
+    print('%d images written to %d shards' % (written, num_shards))
+    return results
+
+
+class Deduplicator:
+    # pixel hashes arrive from the encode workers, so this is only a dict lookup per sample
+    def __init__(self, seen=None):
+        self.seen = seen or {}  # pixel hash -> (label, path)
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.flagged = []
+
+    def keep(self, pixel, label, path, size):
+        if pixel is None:
+            return True
+        if pixel not in self.seen:
+            self.seen[pixel] = (label, path)
+            return True
+        seen_label, seen_path = self.seen[pixel]
+        if seen_label == label:
+            self.dropped += 1
+            self.dropped_bytes += size
+            return False
+        self.flagged.append((path, seen_path))
+        return True
+
+    def report(self, report_path=None):
+        print('dropped %d duplicates within identities (%.1f MB saved), flagged %d duplicates across identities'
+              % (self.dropped, self.dropped_bytes / 2 ** 20, len(self.flagged)))
+        # the report covers this build only, a previous one is replaced
+        if report_path and self.flagged:
+            with open(report_path, 'w') as f:
+                for path, seen_path in self.flagged:
+                    f.write('%s\t%s\n' % (path, seen_path))
+            print('cross identity duplicates listed in %s' % report_path)
+        elif report_path and os.path.exists(report_path):
+            os.remove(report_path)
+
+
+class RecordWriter:
+    # TFRecordWriter that leaves a '<record>.json' header with the codec and format and a
+    # '<record>.index' (offset, length, label) table for utils.RecordIndex on close
+    def __init__(self, path, compression=COMPRESSION, record_format='jpeg'):
+        self.path = path
+        self.header = {'compression': compression or '', 'format': record_format}
+        self.writer = tf.python_io.TFRecordWriter(path, options=compression)
+        self.index = []
+        self.offset = 0
+
+    def write(self, record, label=-1):
+        self.writer.write(record)
+        self.index.append((self.offset, len(record), label))
+        # length (8) + length crc (4) + data + data crc (4), offsets are in the uncompressed stream
+        self.offset += len(record) + 16
+
+    def close(self):
+        self.writer.close()
+        self.header['labels'] = sorted(set(label for _, _, label in self.index))
+        with open(self.path + '.json', 'w') as f:
+            json.dump(self.header, f)
+        with open(self.path + '.index', 'wb') as f:
+            np.save(f, np.array(self.index, dtype=np.int64).reshape(-1, 3))
+
+
+class NpyShardWriter:
+    def __init__(self, path, count):
+        self.images = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8,
+                                                shape=(count, IMAGE_SIZE[1], IMAGE_SIZE[0], 3))
+        self.labels = np.lib.format.open_memmap(path + '.labels', mode='w+', dtype=np.int64, shape=(count,))
+        self.count = 0
+
+    def write(self, img, label):
+        self.images[self.count] = img
+        self.labels[self.count] = label
+        self.count += 1
+
+    def close(self):
+        if self.count < len(self.images):  # duplicates were dropped, shrink to what was written
+            for path, data in ((self.images.filename, self.images), (self.labels.filename, self.labels)):
+                shrunk = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=data.dtype,
+                                                   shape=(self.count,) + data.shape[1:])
+                shrunk[:] = data[:self.count]
+                shrunk.flush()
+                del shrunk
+                os.replace(path + '.tmp', path)
+        else:
+            self.images.flush()
+            self.labels.flush()
+        del self.images, self.labels
+
+
+def encode_sample(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    img = decode_resize(data) if DEDUPE else None
+    return encode_bytes(data, img=img), hashlib.sha1(data).hexdigest(), pixel_hash(img)
+
+
+def hash_sample(path):
+    # (pixel hash, file size) for the Deduplicator without encoding anything
+    if not DEDUPE:
+        return None, os.path.getsize(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    return pixel_hash(decode_resize(data)), len(data)
+
+
+def raw_sample(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    # same channel order tf.image.decode_jpeg gives for the jpeg records
+    img = cv2.cvtColor(decode_resize(data), cv2.COLOR_BGR2RGB)
+    return img, hashlib.sha1(data).hexdigest(), pixel_hash(img) if DEDUPE else None
+
+
+def decode_resize(data):
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img.shape[:2] != (IMAGE_SIZE[1], IMAGE_SIZE[0]):
+        img = cv2.resize(img, IMAGE_SIZE)
+    return img
+
+
+def pixel_hash(img):
+    return hashlib.sha1(img.tobytes()).hexdigest() if img is not None else None
+
+
+def encode_image(path, quality=JPEG_QUALITY, sampling=JPEG_SAMPLING):
+    with open(path, 'rb') as f:
+        return encode_bytes(f.read(), quality, sampling)
+
+
+def encode_bytes(data, quality=JPEG_QUALITY, sampling=JPEG_SAMPLING, img=None):
+    if PASS_THROUGH and jpeg_size(data) == (IMAGE_SIZE[0], IMAGE_SIZE[1], 3):
+        return data
+
+    if img is None:
+        img = decode_resize(data)
+    return cv2.imencode('.jpg', img, jpeg_params(quality, sampling))[1].tostring()
+
+
+def jpeg_params(quality, sampling):
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    if sampling is not None:
+        params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, getattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR_' + sampling)]
+    return params
+
+
+def jpeg_size(data):
+    # walks the marker segments up to the frame header, returns (width, height, components)
+    if data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xff:
+            return None
+        marker = data[i + 1]
+        if marker == 0xff:  # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:  # standalone markers
+            i += 2
+            continue
+        if marker in SOF_MARKERS:
+            height = int.from_bytes(data[i + 5:i + 7], 'big')
+            width = int.from_bytes(data[i + 7:i + 9], 'big')
+            return width, height, data[i + 9]
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    return None
+
+
+def train_example(img, label, text):
+    example = tf.train.Example(features=tf.train.Features(feature={
+        KEY_IMAGE: tf.train.Feature(bytes_list=tf.train.BytesList(value=[img])),
+        KEY_LABEL: tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+        KEY_TEXT: tf.train.Feature(bytes_list=tf.train.BytesList(value=[text]))
+    }))
+    return example.SerializeToString()
+
+
+def write_ver_record(writer, faces, seed=None, num_same=None, num_diff=None, pairs_per_person=SAME_PER_PERSON,
+                     num_workers=NUM_WORKERS, report_path=None, ver_format=VER_FORMAT):
+    # the pool only hashes pixels to drop duplicates before pairs are drawn, then encodes just the images
+    # the drawn pairs use, so pairs_per_person / num_same / num_diff bound the encoding work and memory
+    paths = [path for person_paths in faces.values() for path in person_paths]
+    names = [name for name, person_paths in faces.items() for _ in person_paths]
+    dedupe = Deduplicator()
+    kept = set()
+    with multiprocessing.Pool(num_workers) as pool:
+        for path, name, (pixel, size) in zip(paths, names, pool.imap(hash_sample, paths, chunksize=CHUNK_SIZE)):
+            if dedupe.keep(pixel, name, path, size):
+                kept.add(path)
+        dedupe.report(report_path)
+        faces = {name: [path for path in person_paths if path in kept] for name, person_paths in faces.items()}
+
+        pairs = list(sample_ver_pairs(faces, seed, num_same, num_diff, pairs_per_person))
+        used = list(dict.fromkeys(path for first, second, _ in pairs for path in (first, second)))
+        encoded = dict(zip(used, pool.imap(encode_image, used, chunksize=CHUNK_SIZE)))
+    if ver_format == 'pair_index':
+        write_pair_index(writer, faces, pairs, encoded)
+        return
+
+    count = {0: 0, 1: 0}
+    for first, second, is_same in pairs:
+        write_pair(writer, first, second, is_same, encoded)
+        count[is_same] += 1
+        if (count[0] + count[1]) % 1000 == 0:
+            print('%d pairs written' % (count[0] + count[1]))
+    print('same pairs: %d, diff pairs: %d' % (count[1], count[0]))
+
+
+def sample_ver_pairs(faces, seed=None, num_same=None, num_diff=None, pairs_per_person=SAME_PER_PERSON):
+    # all paths live in one flat list, identity i owns paths[offsets[i]:offsets[i + 1]],
+    # so a negative is one randint over the other identities' range instead of a pool rebuild.
+    rng = np.random.RandomState(seed)
+    paths = [path for person_paths in faces.values() for path in person_paths]
+    counts = np.array([len(person_paths) for person_paths in faces.values()], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    total = len(paths)
+    same_left = np.inf if num_same is None else num_same
+    diff_left = np.inf if num_diff is None else num_diff
+    if diff_left > 0 and np.count_nonzero(counts) < 2:
+        raise ValueError('negative pairs need images of at least two identities, got %d' % np.count_nonzero(counts))
+
+    for person in rng.permutation(len(counts)):
+        if same_left <= 0 and diff_left <= 0:
+            break
+        start, count = offsets[person], counts[person]
+        order = start + rng.permutation(count)
+
+        n_same = int(min(count // 2, pairs_per_person, same_left))
+        for first, second in order[:n_same * 2].reshape(-1, 2):
+            yield paths[first], paths[second], 1
+        same_left -= n_same
+
+        n_diff = int(min(count, pairs_per_person, diff_left)) if count < total else 0
+        if n_diff:
+            others = rng.randint(0, total - count, size=n_diff)
+            others[others >= start] += count
+            for first, second in zip(order[:n_diff], others):
+                yield paths[first], paths[second], 0
+            diff_left -= n_diff
+
+
+def write_pair_index(writer, faces, pairs, encoded):
+    # images are numbered in order of first use, only images that take part in a pair are written
+    index = {}
+    first_idx, second_idx, is_same_list = [], [], []
+    for first, second, is_same in pairs:
+        first_idx.append(index.setdefault(first, len(index)))
+        second_idx.append(index.setdefault(second, len(index)))
+        is_same_list.append(is_same)
+
+    example = tf.train.Example(features=tf.train.Features(feature={
+        KEY_FIRST_IDX: tf.train.Feature(int64_list=tf.train.Int64List(value=first_idx)),
+        KEY_SECOND_IDX: tf.train.Feature(int64_list=tf.train.Int64List(value=second_idx)),
+        KEY_IS_SAME: tf.train.Feature(int64_list=tf.train.Int64List(value=is_same_list))
+    }))
+    writer.write(example.SerializeToString())
+
+    labels = {path: (label, name) for label, (name, paths) in enumerate(faces.items()) for path in paths}
+    for path in index:  # dicts keep insertion order, so this walks the images by index
+        label, name = labels[path]
+        writer.write(train_example(encoded[path], label, name.encode('utf8')), label)
+    print('same pairs: %d, diff pairs: %d, images: %d' %
+          (sum(is_same_list), len(is_same_list) - sum(is_same_list), len(index)))
+
+
+def write_pair(writer, first, second, is_same, encoded=None):
+    img1 = encoded[first] if encoded else encode_image(first)
+    img2 = encoded[second] if encoded else encode_image(second)
+    first_name = first.split('/')[-1].encode('utf8')
+    second_name = second.split('/')[-1].encode('utf8')
+
+    example = tf.train.Example(features=tf.train.Features(feature={
+        KEY_IMAGE_FIRST: tf.train.Feature(bytes_list=tf.train.BytesList(value=[img1])),
+        KEY_IMAGE_SECOND: tf.train.Feature(bytes_list=tf.train.BytesList(value=[img2])),
+        KEY_FIRST_NAME: tf.train.Feature(bytes_list=tf.train.BytesList(value=[first_name])),
+        KEY_SECOND_NAME: tf.train.Feature(bytes_list=tf.train.BytesList(value=[second_name])),
+        KEY_IS_SAME: tf.train.Feature(int64_list=tf.train.Int64List(value=[is_same]))
+    }))
+    writer.write(example.SerializeToString(), is_same)
+
+
+def gen_verification_tfrecord(seed=None, num_same=None, num_diff=None, pairs_per_person=SAME_PER_PERSON,
+                              compression=COMPRESSION, ver_format=VER_FORMAT):
     output_path = os.path.join('tfrecord', 'verification.tfrecord')
-    writer = tf.python_io.TFRecordWriter(output_path)
+    writer = RecordWriter(output_path, compression, ver_format)
 
     directory = os.path.join('images', 'astra_door_align')
     faces = [
@@ -125,7 +595,8 @@ def gen_verification_tfrecord():
 
     faces = {f: glob.glob(os.path.join(directory, f, '*.jpg')) for f in faces}
 
-    write_ver_record(writer, faces)
+    write_ver_record(writer, faces, seed, num_same, num_diff, pairs_per_person,
+                     report_path=os.path.join('tfrecord', 'verification.duplicates'), ver_format=ver_format)
     writer.close()
 
 
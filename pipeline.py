@@ -0,0 +1,424 @@
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import utils
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+CYCLE_LENGTH = 8  # shards read concurrently
+PREFETCH = AUTOTUNE  # batches kept ready ahead of the training step
+BATCH_AUGMENT = True  # run the random augmentations once per batch instead of once per image
+STORED_SIZE = utils.IMAGE_SHAPE[:2]  # (h, w) the records and image folders are written at
+JPEG_RATIOS = (8, 4, 2)  # downscales libjpeg can apply while decoding
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'decode_cache')  # local scratch ($TMPDIR), not the record storage
+FOLDER_MANIFEST = '.files.manifest'  # file list kept inside an image folder tree
+INPUT_READY = 'input_ready'  # graph collection holding the input_ready() timestamp
+
+
+def train_pipeline(pattern, batch_size, record_format='jpeg', shuffle_buffer=0, repeat=False,
+                   drop_remainder=False, num_parallel_calls=AUTOTUNE, cycle_length=CYCLE_LENGTH,
+                   prefetch=PREFETCH, batch_augment=BATCH_AUGMENT, image_size=None, random_crop=None, cache=None,
+                   seed=None, skip=None):
+    # cache: None re-decodes every epoch, '' keeps the decoded samples in RAM, a directory keeps
+    # one cache per shard on disk. npy shards are already decoded and are only cached in RAM.
+    # seed fixes the shard and sample order (a scalar tensor works, e.g. one seed per epoch) and skip
+    # passes over that many samples of it, so a restart resumes an epoch at the sample it stopped at.
+    # skipped records are dropped ahead of the decode whenever the shuffle runs on serialized records.
+    if cache is not None and random_crop:
+        raise ValueError('random_crop is fused into the decode and cannot run behind the sample cache')
+    image_size = tuple(image_size or STORED_SIZE)
+    decode_fn = decode_function(record_format, image_size, random_crop)
+    # shuffle the small serialized records ahead of the decode whenever the decoded stream isn't
+    # replayed from a cache, otherwise the buffer has to hold decoded samples
+    serialized_shuffle = shuffle_buffer and record_format != 'npy' and cache is None
+    if shuffle_buffer:
+        shuffle_report(pattern, shuffle_buffer, image_size, serialized_shuffle)
+    if record_format == 'npy':
+        data_set = utils.npy_dataset(pattern).map(decode_fn, num_parallel_calls=num_parallel_calls)
+    elif cache:
+        tag = '%s-%dx%d' % ((record_format,) + image_size)
+        data_set = cached_records(pattern, decode_fn, cache, tag, cycle_length, num_parallel_calls,
+                                  shuffle_files=bool(shuffle_buffer), seed=seed)
+    else:
+        data_set = interleave_records(pattern, cycle_length, num_parallel_calls, shuffle_files=bool(shuffle_buffer),
+                                      seed=seed)
+        if serialized_shuffle:
+            data_set = data_set.shuffle(buffer_size=shuffle_buffer, seed=seed)
+            if skip is not None:
+                data_set = data_set.skip(skip)
+        data_set = data_set.map(decode_fn, num_parallel_calls=num_parallel_calls)
+    if cache == '':
+        data_set = data_set.cache()
+    if shuffle_buffer and not serialized_shuffle:
+        data_set = data_set.shuffle(buffer_size=shuffle_buffer, seed=seed)
+    if skip is not None and not serialized_shuffle:
+        data_set = data_set.skip(skip)
+
+    # the cache holds un-augmented uint8 samples, so every epoch still sees fresh augmentations
+    if batch_augment:
+        return map_pipeline(data_set, None, batch_size, 0, repeat, drop_remainder,
+                            num_parallel_calls, prefetch, augment_batch_function)
+    return map_pipeline(data_set, utils.augment_function, batch_size, 0, repeat, drop_remainder,
+                        num_parallel_calls, prefetch)
+
+
+def shuffle_report(pattern, shuffle_buffer, image_size, serialized):
+    decoded = image_size[0] * image_size[1] * 3
+    if not serialized:
+        print('shuffle buffer: %d decoded %dx%d samples, %.1f MB' %
+              (shuffle_buffer, image_size[0], image_size[1], shuffle_buffer * decoded / 2 ** 20))
+        return
+    record = record_size(utils.record_files(pattern))
+    print('shuffle buffer: %d serialized records, %s, %.1f MB if it held decoded samples' %
+          (shuffle_buffer, 'size unknown' if record is None else '%.1f MB' % (shuffle_buffer * record / 2 ** 20),
+           shuffle_buffer * decoded / 2 ** 20))
+
+
+def record_size(files):
+    # mean serialized record size from the '<record>.index' sidecars, None without them
+    lengths = [np.load(path + '.index')[:, 1] for path in files if os.path.exists(path + '.index')]
+    lengths = np.concatenate(lengths) if lengths else []
+    return float(np.mean(lengths)) if len(lengths) else None
+
+
+def decode_function(record_format='jpeg', image_size=None, random_crop=None):
+    # uint8 (img, label) at image_size, random_crop only applies to jpeg records
+    image_size = tuple(image_size or STORED_SIZE)
+
+    def decode(*element):
+        if record_format == 'npy':
+            img, label = element
+            return resize_image(img, image_size), label
+        features = utils.parse_example(element[0])
+        label = tf.cast(features['label'], tf.int64)
+        if record_format == 'raw':
+            img = tf.reshape(tf.io.decode_raw(features['image_raw'], tf.uint8), utils.IMAGE_SHAPE)
+            return resize_image(img, image_size), label
+        return decode_jpeg(features['image_raw'], image_size, random_crop), label
+
+    return decode
+
+
+def decode_ratio(source_size, image_size):
+    # largest DCT downscale that still leaves at least image_size pixels of source_size, an int32 tensor
+    ratio = tf.constant(1)
+    for candidate in sorted(JPEG_RATIOS):
+        ratio = tf.where(tf.reduce_all(source_size // candidate >= image_size), candidate, ratio)
+    return ratio
+
+
+def decode_jpeg(contents, image_size=None, random_crop=None):
+    # the DCT downscale is picked from the jpeg's own header, so sources of any size come out at image_size.
+    # random_crop is the fraction of each side kept, the crop is fused into the decode so the
+    # discarded area is never converted to pixels
+    image_size = tuple(image_size or STORED_SIZE)
+    source_size = tf.image.extract_jpeg_shape(contents)[:2]
+    kept_size = source_size
+    if random_crop:
+        kept_size = tf.cast(tf.cast(source_size, tf.float32) * random_crop, tf.int32)
+    ratio = decode_ratio(kept_size, image_size)
+
+    def decode(fixed_ratio):
+        # ratio is an attribute of the decode op, so every candidate gets its own branch
+        def branch():
+            if random_crop:
+                scaled = (source_size + fixed_ratio - 1) // fixed_ratio
+                crop = tf.cast(tf.cast(scaled, tf.float32) * random_crop, tf.int32)
+                offset = tf.cast(tf.random.uniform([2]) * tf.cast(scaled - crop + 1, tf.float32), tf.int32)
+                img = tf.image.decode_and_crop_jpeg(contents, tf.concat([offset, crop], axis=0), channels=3,
+                                                    ratio=fixed_ratio, dct_method='INTEGER_ACCURATE')
+            else:
+                img = tf.image.decode_jpeg(contents, channels=3, ratio=fixed_ratio, dct_method='INTEGER_ACCURATE')
+            return fit_image(img, image_size)
+        return branch
+
+    return tf.case([(tf.equal(ratio, candidate), decode(candidate)) for candidate in JPEG_RATIOS],
+                   default=decode(1), exclusive=True)
+
+
+def fit_image(img, image_size):
+    # reshape when the decode already gave image_size, resize otherwise
+    same = tf.reduce_all(tf.equal(tf.shape(img)[:2], image_size))
+    return tf.cond(same, lambda: resize_image(img, image_size, exact=True),
+                   lambda: resize_image(img, image_size, exact=False))
+
+
+def resize_image(img, image_size, exact=None):
+    # exact means img is already image_size and only its static shape is missing
+    if exact is None:
+        exact = tuple(img.shape.as_list()[:2]) == tuple(image_size)
+    if exact:
+        return tf.reshape(img, (image_size[0], image_size[1], 3))
+    img = tf.compat.v1.image.resize(img, image_size)
+    return tf.saturate_cast(img, tf.uint8)
+
+
+def interleave_records(pattern, cycle_length=CYCLE_LENGTH, num_parallel_calls=AUTOTUNE, shuffle_files=False,
+                       seed=None):
+    files = utils.record_files(pattern)
+    compression = utils.common_compression(files)
+    data_set = tf.data.Dataset.from_tensor_slices(files)
+    if shuffle_files:
+        data_set = data_set.shuffle(len(files), seed=seed)  # a new shard order every epoch
+    return data_set.interleave(lambda path: tf.data.TFRecordDataset(path, compression_type=compression),
+                               cycle_length=min(cycle_length, len(files)),
+                               num_parallel_calls=num_parallel_calls)
+
+
+def cached_records(pattern, decode_fn, cache_dir, tag, cycle_length=CYCLE_LENGTH, num_parallel_calls=AUTOTUNE,
+                   shuffle_files=False, seed=None):
+    files = utils.record_files(pattern)
+    compression = utils.common_compression(files)
+    caches = prepare_caches(files, cache_dir, tag)
+    data_set = tf.data.Dataset.from_tensor_slices((files, caches))
+    if shuffle_files:
+        data_set = data_set.shuffle(len(files), seed=seed)
+    return data_set.interleave(
+        lambda path, cache: tf.data.TFRecordDataset(path, compression_type=compression)
+        .map(decode_fn, num_parallel_calls=num_parallel_calls)
+        .cache(cache),
+        cycle_length=min(cycle_length, len(files)),
+        num_parallel_calls=num_parallel_calls)
+
+
+def prepare_caches(files, cache_dir, tag):
+    # a shard's cache is keyed by the shard's path, size and mtime plus the decode settings (tag),
+    # a rebuilt shard gets a new key and its old cache is removed
+    os.makedirs(cache_dir, exist_ok=True)
+    caches = []
+    hits = cached_bytes = 0
+    for path in files:
+        stat = os.stat(path)
+        source = '%s:%d:%d' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        prefix = os.path.join(cache_dir, '%s.%s.' % (os.path.basename(path), tag))
+        cache = prefix + hashlib.sha1(source.encode()).hexdigest()[:16]
+        # a lockfile means a previous run stopped half way through writing the cache
+        complete = os.path.exists(cache + '.index') and not glob.glob(cache + '*.lockfile')
+        for name in glob.glob(prefix + '*'):
+            if not name.startswith(cache) or not complete:
+                os.remove(name)
+        if complete:
+            hits += 1
+            cached_bytes += sum(os.path.getsize(name) for name in glob.glob(cache + '*'))
+        caches.append(cache)
+    print('decode cache: %d/%d shards hit (%.0f%%), %.1f MB in %s' %
+          (hits, len(files), 100.0 * hits / len(files), cached_bytes / 2 ** 20, cache_dir))
+    return caches
+
+
+def folder_files(data_dir, pattern='*.jpg'):
+    # (paths, class names) of data_dir/<class>/<pattern>. The listing is persisted in data_dir and
+    # only class folders whose mtime changed are listed again, the rest costs one stat per class.
+    manifest_path = os.path.join(data_dir, FOLDER_MANIFEST)
+    cached = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.loads(f.readline())['pattern'] == pattern:
+                cached = {entry['class']: entry for entry in map(json.loads, f)}
+
+    entries = []
+    changed = False
+    for folder in sorted(os.scandir(data_dir), key=lambda item: item.name):
+        if not folder.is_dir():
+            continue
+        mtime = folder.stat().st_mtime_ns
+        entry = cached.get(folder.name)
+        if entry is None or entry['mtime'] != mtime:
+            files = sorted(os.path.basename(path) for path in glob.glob(os.path.join(folder.path, pattern)))
+            entry = {'class': folder.name, 'mtime': mtime, 'files': files}
+            changed = True
+        entries.append(entry)
+
+    if changed or len(entries) != len(cached):
+        with open(manifest_path, 'w') as f:
+            f.write(json.dumps({'pattern': pattern}) + '\n')
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+
+    paths = [os.path.join(data_dir, entry['class'], name) for entry in entries for name in entry['files']]
+    return paths, [entry['class'] for entry in entries]
+
+
+def class_table(class_names, default_value=-1):
+    # in-graph class folder name -> label index
+    initializer = tf.lookup.KeyValueTensorInitializer(tf.constant(list(class_names)),
+                                                      tf.range(len(class_names), dtype=tf.int64))
+    return tf.lookup.StaticHashTable(initializer, default_value)
+
+
+def map_pipeline(data_set, map_fn, batch_size, shuffle_buffer=0, repeat=False, drop_remainder=False,
+                 num_parallel_calls=AUTOTUNE, prefetch=PREFETCH, batch_map_fn=None):
+    if map_fn is not None:
+        data_set = data_set.map(map_fn, num_parallel_calls=num_parallel_calls)
+    if shuffle_buffer:
+        data_set = data_set.shuffle(buffer_size=shuffle_buffer)
+    if repeat:
+        data_set = data_set.repeat()
+    data_set = data_set.batch(batch_size, drop_remainder=drop_remainder)
+    if batch_map_fn is not None:
+        data_set = data_set.map(batch_map_fn, num_parallel_calls=num_parallel_calls)
+    return data_set.prefetch(buffer_size=prefetch)
+
+
+def augment_batch_function(images, labels):
+    images = augment_batch(images)
+    images = tf.subtract(images, 127.5)
+    images = tf.multiply(images, 0.0078125)
+    return images, labels
+
+
+def augment_batch(images, max_value=255.0):
+    # same ranges as utils.augment_function, but every random parameter is drawn as a
+    # [B, 1, 1, 1] vector so a whole [B, H, W, 3] batch is augmented by a handful of ops
+    images = tf.cast(images, tf.float32) / max_value
+    batch = tf.shape(images)[0]
+
+    def uniform(low, high):
+        return tf.random.uniform([batch, 1, 1, 1], low, high)
+
+    images = tf.clip_by_value(images + uniform(-0.2, 0.2), 0.0, 1.0)  # brightness
+
+    hsv = tf.image.rgb_to_hsv(images)  # saturation
+    hue, saturation, value = tf.split(hsv, 3, axis=-1)
+    saturation = tf.clip_by_value(saturation * uniform(0.6, 1.6), 0.0, 1.0)
+    images = tf.image.hsv_to_rgb(tf.concat([hue, saturation, value], axis=-1))
+
+    mean = tf.reduce_mean(images, axis=[1, 2], keepdims=True)  # contrast
+    images = tf.clip_by_value((images - mean) * uniform(0.6, 1.4) + mean, 0.0, 1.0)
+
+    flip = tf.cast(uniform(0.0, 1.0) < 0.5, tf.float32)  # left right flip
+    images = flip * tf.reverse(images, axis=[2]) + (1.0 - flip) * images
+
+    return images * max_value
+
+
+def input_ready(tensor):
+    # wall clock time at which tensor became available inside a session run. Fetched next to the
+    # train op it splits the run into getting the input in (before) and compute (after).
+    with tf.control_dependencies([tensor]):
+        ready = tf.timestamp(name='input_ready')
+    tf.compat.v1.add_to_collection(INPUT_READY, ready)
+    return ready
+
+
+class StepTimer:
+    # time per step spent waiting for data, feeding it to the runtime, computing and logging.
+    # extra phases (e.g. triplet mining) are reported on their own and don't count as input-bound
+    PHASES = ('wait', 'feed', 'compute', 'log')
+
+    def __init__(self, extra_phases=()):
+        self.phases = self.PHASES + tuple(extra_phases)
+        self.seconds = dict.fromkeys(self.phases, 0.0)
+        self.steps = 0
+
+    def add(self, phase, seconds):
+        self.seconds[phase] += max(seconds, 0.0)
+
+    def run(self, start, ready, end, phase='feed'):
+        # one train step run, split at its input_ready timestamp
+        self.add(phase, ready - start)
+        self.add('compute', end - ready)
+        self.steps += 1
+
+    def report(self):
+        # log line and summary for the steps since the last report
+        steps = max(self.steps, 1)
+        total = max(sum(self.seconds.values()), 1e-9)
+        input_bound = 100.0 * (self.seconds['wait'] + self.seconds['feed']) / total
+        ms = [(phase, 1000.0 * self.seconds[phase] / steps) for phase in self.phases]
+        line = 'step time: %s, input-bound %.0f%%' % (', '.join('%s %.1fms' % item for item in ms), input_bound)
+        values = [tf.compat.v1.Summary.Value(tag='step_time/%s_ms' % phase, simple_value=value) for phase, value in ms]
+        values.append(tf.compat.v1.Summary.Value(tag='step_time/input_bound', simple_value=input_bound))
+        self.seconds = dict.fromkeys(self.phases, 0.0)
+        self.steps = 0
+        return line, tf.compat.v1.Summary(value=values)
+
+
+class ThroughputCounter:
+    # samples/sec over the window since the last rate() call and since start. fed with trained batches it
+    # measures end-to-end training throughput, benchmark_input.py measures the input pipeline on its own
+    def __init__(self):
+        self.start = self.window_start = time.time()
+        self.total = self.window = 0
+
+    def update(self, count):
+        self.total += count
+        self.window += count
+
+    def rate(self):
+        now = time.time()
+        rate = self.window / max(now - self.window_start, 1e-9)
+        self.window_start, self.window = now, 0
+        return rate
+
+    def average(self):
+        return self.total / max(time.time() - self.start, 1e-9)
+
+
+class ThroughputHook(tf.compat.v1.train.SessionRunHook):
+    def __init__(self, batch_size, every_n_steps=100):
+        self.batch_size = batch_size
+        self.every_n_steps = every_n_steps
+        self.counter = None
+        self.step = 0
+
+    def begin(self):
+        self.counter = ThroughputCounter()
+
+    def after_run(self, run_context, run_values):
+        self.counter.update(self.batch_size)
+        self.step += 1
+        if self.step % self.every_n_steps == 0:
+            tf.compat.v1.logging.info('training throughput: %.1f samples/sec' % self.counter.rate())
+
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    def __init__(self, batch_size, every_n_steps=100):
+        super().__init__()
+        self.batch_size = batch_size
+        self.every_n_steps = every_n_steps
+        self.counter = ThroughputCounter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.counter.update(self.batch_size)
+        if (batch + 1) % self.every_n_steps == 0:
+            print('\n training throughput: %.1f samples/sec' % self.counter.rate())
+
+
+class StepTimerHook(tf.compat.v1.train.SessionRunHook):
+    # needs input_ready() on the features in model_fn, time between runs counts as logging
+    def __init__(self, output_dir, every_n_steps=100):
+        self.output_dir = output_dir
+        self.every_n_steps = every_n_steps
+        self.timer = None
+        self.ready = None
+        self.global_step = None
+        self.writer = None
+        self.start = self.end = None
+
+    def begin(self):
+        self.timer = StepTimer()
+        self.ready = tf.compat.v1.get_collection(INPUT_READY)[0]
+        self.global_step = tf.compat.v1.train.get_global_step()
+        self.writer = tf.compat.v1.summary.FileWriterCache.get(self.output_dir)
+
+    def before_run(self, run_context):
+        self.start = time.time()
+        if self.end is not None:
+            self.timer.add('log', self.start - self.end)
+        return tf.compat.v1.train.SessionRunArgs([self.ready, self.global_step])
+
+    def after_run(self, run_context, run_values):
+        self.end = time.time()
+        ready, step = run_values.results
+        self.timer.run(self.start, ready, self.end, phase='wait')
+        if self.timer.steps >= self.every_n_steps:
+            line, summary = self.timer.report()
+            tf.compat.v1.logging.info(line)
+            self.writer.add_summary(summary, step)
@@ -1,4 +1,5 @@
 import face_recognition as fr
+import face_recognition_models
 import numpy as np
 import utils
 
@@ -9,21 +10,19 @@ LFW_PATH = 'tfrecord/lfw.bin'
 
 def main():
     # estimator method
-    def embedding_fn(img1, img2):
-        h, w, _ = img1.shape
-        img1 = img1 / 0.0078125 + 127.5
-        img2 = img2 / 0.0078125 + 127.5
-        img1 = img1.astype(np.uint8)
-        img2 = img2.astype(np.uint8)
-        result1 = fr.face_encodings(img1, [(0, w, h, 0)])[0]
-        result2 = fr.face_encodings(img2, [(0, w, h, 0)])[0]
-        vector_pair = utils.preprocessing.normalize([result1, result2])
-
-        return vector_pair
+    def embedding_fn(images):
+        _, h, w, _ = images.shape
+        images = (images / 0.0078125 + 127.5).astype(np.uint8)
+        results = [fr.face_encodings(img, [(0, w, h, 0)])[0] for img in images]
+
+        return utils.preprocessing.normalize(results)
+
+    cache = utils.EmbeddingCache(utils.model_hash(face_recognition_models.face_recognition_model_location()),
+                                 {'shape': SHAPE})
 
     # gen_model()
-    utils.test_tfrecord('verification.tfrecord', embedding_fn, SHAPE, is_plot=PLOT_ROC)
-    utils.test_lfw(LFW_PATH, embedding_fn, SHAPE, is_plot=PLOT_ROC)
+    utils.test_tfrecord('verification.tfrecord', embedding_fn, SHAPE, is_plot=PLOT_ROC, cache=cache)
+    utils.test_lfw(LFW_PATH, embedding_fn, SHAPE, is_plot=PLOT_ROC, cache=cache)
 
 
 if __name__ == '__main__':
@@ -21,14 +21,14 @@ def main():
                                             config=tf.ConfigProto(allow_soft_placement=True))
 
     # estimator method
-    def embedding_fn(img1, img2):
-        result1 = predict_fn({'input_image': [img1]})['l2_embeddings']
-        result2 = predict_fn({'input_image': [img2]})['l2_embeddings']
-        return result1, result2
+    def embedding_fn(images):
+        return predict_fn({'input_image': images})['l2_embeddings']
+
+    cache = utils.EmbeddingCache(utils.model_hash(SAVED_MODEL_PATH), {'shape': SHAPE})
 
     # gen_model()
-    # utils.test_tfrecord('verification.tfrecord', embedding_fn, SHAPE, is_plot=PLOT_ROC)
-    utils.test_lfw(LFW_PATH, embedding_fn, SHAPE, is_plot=PLOT_ROC)
+    # utils.test_tfrecord('verification.tfrecord', embedding_fn, SHAPE, is_plot=PLOT_ROC, cache=cache)
+    utils.test_lfw(LFW_PATH, embedding_fn, SHAPE, is_plot=PLOT_ROC, cache=cache)
 
 
 def gen_model():
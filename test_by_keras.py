@@ -15,6 +15,13 @@ RESTORE_BY_WEIGHT = True
 
 
 def main():
+    # hashed before weight.h5 is written into the model directory
+    if RESTORE_BY_WEIGHT:
+        model_key = utils.model_hash('model_out/keras_best/saved_model.pb', 'model_out/keras_best/variables')
+    else:
+        model_key = utils.model_hash('model_out/keras_embedding')
+    cache = utils.EmbeddingCache(model_key, {'shape': SHAPE, 'restore_by_weight': RESTORE_BY_WEIGHT})
+
     if RESTORE_BY_WEIGHT:
         model = tf.keras.models.load_model('model_out/keras_best')
         model.save_weights('model_out/keras_best/weight.h5')
@@ -22,18 +29,12 @@ def main():
     else:
         model = tf.keras.models.load_model('model_out/keras_embedding')
 
-    def embedding_fn(img1, img2):
-        h, w, _ = img1.shape
-        result1 = model.predict(np.expand_dims(img1, axis=0))
-        result2 = model.predict(np.expand_dims(img2, axis=0))
-        result1 = preprocessing.normalize(result1, norm='l2')
-        result2 = preprocessing.normalize(result2, norm='l2')
-
-        return result1, result2
+    def embedding_fn(images):
+        return preprocessing.normalize(model.predict(images), norm='l2')
 
     # gen_model()
-    utils.test_tfrecord('verification.tfrecord', embedding_fn, SHAPE, is_plot=PLOT_ROC, verbose=True)
-    # utils.test_lfw(LFW_PATH, embedding_fn, SHAPE, is_plot=PLOT_ROC)
+    utils.test_tfrecord('verification.tfrecord', embedding_fn, SHAPE, is_plot=PLOT_ROC, verbose=True, cache=cache)
+    # utils.test_lfw(LFW_PATH, embedding_fn, SHAPE, is_plot=PLOT_ROC, cache=cache)
 
 
 def restore_weight(path):
@@ -0,0 +1,72 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('cv2')
+pytest.importorskip('sklearn')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline  # noqa: E402
+import utils  # noqa: E402
+
+BATCH_SIZE = 4
+SHARDS = 2
+PER_SHARD = 12
+
+
+def write_raw_shards(output_dir):
+    for shard in range(SHARDS):
+        path = os.path.join(output_dir, 'train-%05d-of-%05d.tfrecord' % (shard, SHARDS))
+        with tf.io.TFRecordWriter(path) as writer:
+            for k in range(PER_SHARD):
+                label = shard * PER_SHARD + k
+                img = np.full(utils.IMAGE_SHAPE, label, dtype=np.uint8)
+                writer.write(tf.train.Example(features=tf.train.Features(feature={
+                    'image_raw': tf.train.Feature(bytes_list=tf.train.BytesList(value=[img.tobytes()])),
+                    'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+                })).SerializeToString())
+    return os.path.join(output_dir, 'train-*-of-*.tfrecord')
+
+
+def epoch_labels(pattern, epoch, consumed=0, steps=None):
+    # train.py's setup: the seed and the skipped sample count are fed when the iterator is initialized
+    with tf.Graph().as_default():
+        seed = tf.compat.v1.placeholder_with_default(tf.constant(0, tf.int64), [])
+        skip = tf.compat.v1.placeholder_with_default(tf.constant(0, tf.int64), [])
+        data_set = pipeline.train_pipeline(pattern, BATCH_SIZE, 'raw', shuffle_buffer=8, drop_remainder=True,
+                                           seed=seed, skip=skip)
+        iterator = tf.compat.v1.data.make_initializable_iterator(data_set)
+        next_element = iterator.get_next()
+        batches = []
+        with tf.compat.v1.Session() as sess:
+            sess.run(iterator.initializer, feed_dict={seed: epoch, skip: consumed * BATCH_SIZE})
+            try:
+                while steps is None or len(batches) < steps:
+                    batches.append(sess.run(next_element)[1].tolist())
+            except tf.errors.OutOfRangeError:
+                pass
+        return batches
+
+
+def test_resume_mid_epoch(tmp_path):
+    pattern = write_raw_shards(str(tmp_path))
+    full = epoch_labels(pattern, epoch=3)
+    assert len(full) == SHARDS * PER_SHARD // BATCH_SIZE
+
+    trained = epoch_labels(pattern, epoch=3, steps=2)
+    assert trained == full[:2]
+    ckpt = os.path.join(str(tmp_path), 'MDL_iter_2.ckpt')
+    utils.save_train_state(ckpt, step=3, epoch=3, consumed=len(trained))
+
+    state = utils.load_train_state(ckpt)
+    resumed = epoch_labels(pattern, state['epoch'], state['consumed'])
+    assert resumed == full[2:]
+
+
+def test_epochs_differ(tmp_path):
+    pattern = write_raw_shards(str(tmp_path))
+    assert epoch_labels(pattern, epoch=0) != epoch_labels(pattern, epoch=1)
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('tensorflow')
+pytest.importorskip('cv2')
+pytest.importorskip('sklearn')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils  # noqa: E402
+
+CASES = [
+    # ties inside and across the classes
+    ([0.1, 0.1, 0.2, 0.2, 0.2, 0.5, 0.7, 0.7], [1, 0, 1, 1, 0, 0, 1, 0]),
+    # distances where a fixed epsilon is lost
+    ([1e12, 2e12, 2e12, 3e12], [1, 1, 0, 0]),
+    # adjacent floats, their midpoint rounds onto one of them
+    ([1.0, np.nextafter(1.0, 2.0), 2.0], [1, 0, 0]),
+    ([0.3], [1]),
+    ([0.4, 0.4, 0.4], [0, 1, 0]),
+]
+
+
+@pytest.mark.parametrize('dist, is_same', CASES)
+def test_counts_match_brute_force(dist, is_same):
+    dist = np.array(dist, dtype=np.float64)
+    is_same = np.array(is_same, dtype=bool)
+    metrics = utils.roc_metrics(dist, is_same)
+    same, diff = int(np.sum(is_same)), int(np.sum(~is_same))
+
+    assert len(metrics.thresholds) == len(np.unique(dist)) + 1
+    assert np.all(np.isfinite(metrics.thresholds))
+    for thr, tpr, fpr in zip(metrics.thresholds, metrics.tpr, metrics.fpr):
+        predict = np.less(dist, thr)
+        assert round(tpr * max(same, 1)) == np.sum(predict & is_same)
+        assert round(fpr * max(diff, 1)) == np.sum(predict & ~is_same)
+
+    predict = np.less(dist, metrics.threshold)
+    assert metrics.tp == np.sum(predict & is_same)
+    assert metrics.fp == np.sum(predict & ~is_same)
+    assert metrics.fn == np.sum(~predict & is_same)
+    assert metrics.tn == np.sum(~predict & ~is_same)
+    best = max(np.mean(np.less(dist, thr) == is_same) for thr in np.r_[dist, np.inf])
+    assert metrics.accuracy == pytest.approx(best)
+
+
+def test_empty_raises():
+    with pytest.raises(ValueError):
+        utils.roc_metrics([], [])
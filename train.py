@@ -12,6 +12,7 @@ import tensorflow as tf
 from sklearn import preprocessing
 from tensorflow.core.protobuf import config_pb2
 
+import pipeline
 import utils
 from backend.loss_function import combine_loss_val
 from backend.net_builder import NetBuilder, Arch, FinalLayer
@@ -24,7 +25,7 @@ LR_VAL = [0.01, 0.005, 0.001, 0.0005]
 ACC_LOW_BOUND = 0.85
 NUM_CLASSES = 1037
 BATCH_SIZE = 32
-BUFFER_SIZE = 500
+BUFFER_SIZE = 10000  # serialized records, see the shuffle buffer line printed at startup
 EPOCH = 10000
 SAVER_MAX_KEEP = 5
 MOMENTUM = 0.9
@@ -38,6 +39,20 @@ SUMMARY_INTERVAL = 2000
 CKPT_INTERVAL = 1000
 VALIDATE_INTERVAL = 2000
 MONITOR_NODE = ''
+TRAIN_RECORD = os.path.join('tfrecord', 'train-*-of-*.tfrecord')  # 'train-*-of-*.npy' for npy shards
+RECORD_FORMAT = 'jpeg'  # same as image2tfrecord.RECORD_FORMAT: 'jpeg', 'raw' or 'npy'
+CLASS_BALANCED = False  # reads tfrecords through their '.index' sidecars (layout='identity' reads best), never ends
+IMAGES_PER_IDENTITY = 4
+ITERATOR_INPUT = True  # feed the net from the iterator in-graph, False for the numpy feed_dict round trip
+# decoded samples kept across epochs (pipeline.CACHE_DIR on disk, '' for RAM), the shuffle buffer then holds
+# decoded samples instead of serialized records, so size BUFFER_SIZE down with it. A decoded sample is ~150 KB
+# against ~25 KB of jpeg, so the disk cache only pays off on fast local scratch: pointed at the same network
+# storage as the records, cached epochs read ~6x more bytes from it than decoding the jpegs again
+DECODE_CACHE = None
+# [(from step, (h, w)), ...] e.g. [(0, (112, 112)), (40000, (160, 160)), (120000, (224, 224))], None trains at
+# INPUT_SIZE throughout. Needs an arch that ends in global pooling (RES_NET34, RES_NET50) with FinalLayer.G.
+RESOLUTION_SCHEDULE = None
+TARGET_ACCURACY = 0.95  # logs the wall clock time at which validation first reaches it
 
 
 def purge():
@@ -80,14 +95,33 @@ def main():
     purge()
     init_log()
 
-    builder = NetBuilder()
-
-    record_path = os.path.join('tfrecord', 'train.tfrecord')
-    data_set = tf.data.TFRecordDataset(record_path)
-    data_set = data_set.map(utils.parse_function)
-    data_set = data_set.shuffle(buffer_size=BUFFER_SIZE)
-    data_set = data_set.batch(BATCH_SIZE)
-    iterator = data_set.make_initializable_iterator()
+    builder = NetBuilder(INPUT_SIZE)
+
+    stages = RESOLUTION_SCHEDULE or [(0, builder.input_size)]
+    if len(stages) > 1 and MODEL not in (Arch.RES_NET34, Arch.RES_NET50):
+        raise ValueError('%s has no global pooling, it can only train at one resolution' % MODEL.name)
+    if stages[0][0] != 0 or any(later <= earlier for (earlier, _), (later, _) in zip(stages, stages[1:])):
+        raise ValueError('RESOLUTION_SCHEDULE has to start at step 0 and increase: %s' % stages)
+    log('resolution schedule: %s' % stages)
+    # every epoch is shuffled with its own seed, so a resumed epoch or a stage taking over mid-epoch replays
+    # the same order and skip_samples drops the part of it that was already trained on
+    epoch_seed = tf.placeholder_with_default(tf.constant(0, tf.int64), [], name='epoch_seed')
+    skip_samples = tf.placeholder_with_default(tf.constant(0, tf.int64), [], name='skip_samples')
+    iterators = [train_dataset(size, epoch_seed, skip_samples).make_initializable_iterator() for _, size in stages]
+    stage_handle = None
+    input_shape = [None, INPUT_SIZE[0], INPUT_SIZE[1], 3]
+    if len(iterators) == 1:
+        iterator = iterators[0]
+    else:
+        # one pipeline per resolution, the net reads whichever one stage_handle points at
+        stage_handle = tf.placeholder(tf.string, shape=[], name='stage_handle')
+        iterator = tf.data.Iterator.from_string_handle(
+            stage_handle, iterators[0].output_types,
+            (tf.TensorShape([None, None, None, 3]), tf.TensorShape([None])))
+        input_shape = [None, None, None, 3]
+    handle_ops = [it.string_handle() for it in iterators]
+    throughput = pipeline.ThroughputCounter()
+    timer = pipeline.StepTimer()
     next_element = iterator.get_next()
 
     verification_path = os.path.join('tfrecord', 'verification.tfrecord')
@@ -100,15 +134,28 @@ def main():
 
         global_step = tf.Variable(
             name='global_step', initial_value=0, trainable=False)
-        input_layer = tf.placeholder(
-            name='input_images',
-            shape=[None, INPUT_SIZE[0], INPUT_SIZE[1], 3],
-            dtype=tf.float32)
-        labels = tf.placeholder(
-            name='img_labels', shape=[
-                None,
-            ], dtype=tf.int64)
+        if ITERATOR_INPUT:
+            # feeding input_images still works (validation, export) and then skips the iterator
+            input_layer = tf.placeholder_with_default(
+                next_element[0],
+                name='input_images',
+                shape=input_shape)
+            labels = tf.placeholder_with_default(
+                next_element[1],
+                name='img_labels', shape=[
+                    None,
+                ])
+        else:
+            input_layer = tf.placeholder(
+                name='input_images',
+                shape=input_shape,
+                dtype=tf.float32)
+            labels = tf.placeholder(
+                name='img_labels', shape=[
+                    None,
+                ], dtype=tf.int64)
         is_training = tf.placeholder_with_default(False, (), name='is_training')
+        input_ready = pipeline.input_ready(input_layer)
         net = builder.input_and_train_node(input_layer, is_training) \
             .arch_type(MODEL) \
             .final_layer_type(FinalLayer.G) \
@@ -182,31 +229,69 @@ def main():
         sess.run(tf.global_variables_initializer())
         sess.run(tf.local_variables_initializer())
 
+        state = None
         if args.pretrain != '':
             restore_saver = tf.train.Saver()
             restore_saver.restore(sess,
                                   os.path.join(MODEL_OUT_PATH, args.pretrain))
+            state = utils.load_train_state(os.path.join(MODEL_OUT_PATH, args.pretrain))
 
-        step = 0
+        step = 0 if state is None else state['step']
         have_best = False
         best_accuracy = 0
-        for i in range(EPOCH):
-            sess.run(iterator.initializer)
+        handles = sess.run(handle_ops)
+        stage = None
+        train_start = time.time()
+        reached_target = False
+        for i in range(0 if state is None else state['epoch'], EPOCH):
+            # batches trained on in this epoch, whichever stage they came from
+            consumed = 0 if state is None else state.get('consumed', 0)
+            if state is not None:
+                log('resumed at epoch %d, step %d, %d batches in.' % (i, step, consumed))
+                state = None
+            active = None  # stage whose iterator has been initialized for this epoch
             while True:
                 try:
-                    images_train, labels_train = sess.run(next_element)
-                    if images_train.shape[0] != BATCH_SIZE:
-                        break
-                    feed_dict = {
-                        input_layer: images_train,
-                        labels: labels_train,
-                        is_training: True
-                    }
+                    fetches = [train_op, total_loss, inference_loss, wd_loss, acc, input_ready]
+                    current = max(k for k, (start, _) in enumerate(stages) if start <= step)
+                    if current != active:
+                        # a stage taking over mid-epoch starts where the previous one stopped
+                        active = current
+                        sess.run(iterators[active].initializer,
+                                 feed_dict={epoch_seed: i, skip_samples: consumed * BATCH_SIZE})
+                    stage_feed = {}
+                    if stage_handle is not None:
+                        if current != stage:
+                            stage = current
+                            log('step %d: training at %dx%d.' % ((step,) + tuple(stages[stage][1])))
+                        stage_feed = {stage_handle: handles[stage]}
+                    if ITERATOR_INPUT:
+                        feed_dict = {is_training: True}
+                        feed_dict.update(stage_feed)
+                        # the batch only comes back to numpy on the steps that log it
+                        if MONITOR_NODE != '' or step % SHOW_INFO_INTERVAL == 0 or step % SUMMARY_INTERVAL == 0:
+                            fetches += [input_layer, labels]
+                    else:
+                        wait_start = time.time()
+                        images_train, labels_train = sess.run(next_element, feed_dict=stage_feed)
+                        timer.add('wait', time.time() - wait_start)
+                        if images_train.shape[0] != BATCH_SIZE:
+                            break
+                        feed_dict = {
+                            input_layer: images_train,
+                            labels: labels_train,
+                            is_training: True
+                        }
                     start = time.time()
-                    _, total_loss_val, inference_loss_val, wd_loss_val, acc_val = \
-                        sess.run([train_op, total_loss, inference_loss, wd_loss, acc],
-                                 feed_dict=feed_dict,
-                                 options=config_pb2.RunOptions(report_tensor_allocations_upon_oom=True))
+                    results = sess.run(fetches, feed_dict=feed_dict,
+                                       options=config_pb2.RunOptions(report_tensor_allocations_upon_oom=True))
+                    _, total_loss_val, inference_loss_val, wd_loss_val, acc_val, ready = results[:6]
+                    consumed += 1
+                    if len(results) > 6:
+                        images_train, labels_train = results[6:]
+                    # with ITERATOR_INPUT the iterator runs inside the step, so the input part is waiting
+                    timer.run(start, ready, time.time(), phase='wait' if ITERATOR_INPUT else 'feed')
+                    log_start = time.time()
                     if MONITOR_NODE != '':
                         mon_dict = {
                             input_layer: images_train,
@@ -218,6 +303,7 @@ def main():
                         log('{} max value: {}'.format(MONITOR_NODE, np.max(node_v)), verbose=False)
                     end = time.time()
                     pre_sec = BATCH_SIZE / (end - start)
+                    throughput.update(BATCH_SIZE)
                     if step == 0:
                         step += 1
                         continue
@@ -227,21 +313,31 @@ def main():
                                   inference_loss_val, input_layer,
                                   labels_train, net, pre_sec, sess,
                                   total_loss_val, is_training, wd_loss_val)
+                        log('training throughput: %.1f samples/sec' % throughput.rate())
+                        step_time, step_time_summary = timer.report()
+                        log(step_time)
+                        summary.add_summary(step_time_summary, step)
                     # save summary
                     if step % SUMMARY_INTERVAL == 0:
                         save_summary(step, images_train, input_layer, labels,
                                      labels_train, sess, summary, summary_op,
                                      is_training)
+                    timer.add('log', time.time() - log_start)
 
                     # save ckpt files
                     if step % CKPT_INTERVAL == 0 and not have_best:
-                        save_ckpt(step, i, saver, sess)
+                        save_ckpt(step, i, saver, sess, consumed)
 
                     # validate
                     if step % VALIDATE_INTERVAL == 0:
                         val_accuracy, is_best = validate(best_accuracy, step,
                                                          input_layer, net, saver, sess,
                                                          is_training, ver_dataset)
+                        minutes = (time.time() - train_start) / 60
+                        log('validation at step %d after %.1f min: accuracy %.4f' % (step, minutes, val_accuracy))
+                        if not reached_target and TARGET_ACCURACY <= val_accuracy:
+                            reached_target = True
+                            log('time to %.3f accuracy: %.1f min, step %d' % (TARGET_ACCURACY, minutes, step))
                         if is_best:
                             best_accuracy = val_accuracy
                         if not have_best and is_best:
@@ -259,6 +355,20 @@ def main():
                     raise err
 
 
+def train_dataset(image_size, seed=None, skip=None):
+    if CLASS_BALANCED:
+        if RECORD_FORMAT == 'npy':
+            raise ValueError('CLASS_BALANCED reads tfrecord shards through their index, it can\'t sample npy shards')
+        data_set = utils.identity_dataset(TRAIN_RECORD, images_per_identity=IMAGES_PER_IDENTITY)
+        if skip is not None:
+            data_set = data_set.skip(skip)
+        return pipeline.map_pipeline(data_set, pipeline.decode_function(RECORD_FORMAT, image_size),
+                                     BATCH_SIZE, drop_remainder=True,
+                                     batch_map_fn=pipeline.augment_batch_function)
+    return pipeline.train_pipeline(TRAIN_RECORD, BATCH_SIZE, RECORD_FORMAT, shuffle_buffer=BUFFER_SIZE,
+                                   drop_remainder=True, image_size=image_size, cache=DECODE_CACHE, seed=seed, skip=skip)
+
+
 def validate(best_accuracy, step, input_layer, net, saver, sess, is_training,
              ver_dataset):
     feed_dict_test = {is_training: False}
@@ -278,11 +388,13 @@ def validate(best_accuracy, step, input_layer, net, saver, sess, is_training,
     return val_acc, False
 
 
-def save_ckpt(step, i, saver, sess):
+def save_ckpt(step, i, saver, sess, consumed):
     log('epoch: %d,step: %d, saving ckpt.' % (i, step))
     filename = '{:s}_iter_{:d}.ckpt'.format(MODEL.name, step)
     filename = os.path.join(MODEL_OUT_PATH, filename)
     saver.save(sess, filename)
+    # the position is the epoch's batch count, the iterators themselves run stateful random ops and can't be saved
+    utils.save_train_state(filename, step=step + 1, epoch=i, consumed=consumed)
 
 
 def save_summary(step, images_train, input_layer, labels, labels_train, sess,
@@ -2,6 +2,7 @@ import os
 
 import tensorflow as tf
 
+import pipeline
 from estimator.model_fn import model_fn
 from estimator.input_fn import train_input_fn, test_input_fn, serving_input_receiver_fn
 from estimator.utils import Params
@@ -29,7 +30,8 @@ def main():
         run_every_secs=None,
         run_every_steps=params.save_checkpoints_steps)
     train_spec = tf.estimator.TrainSpec(input_fn=lambda: train_input_fn('train_1036.tfrecord', params),
-                                        hooks=[])
+                                        hooks=[pipeline.ThroughputHook(params.batch_size, params.log_steps),
+                                               pipeline.StepTimerHook(config.model_dir, params.log_steps)])
 
     exporter = tf.estimator.BestExporter(
         name="best_exporter",
@@ -1,18 +1,18 @@
 import os
-import pathlib
 
 import numpy as np
 import tensorflow as tf
 from sklearn import preprocessing
 
+import pipeline
 import utils
 
 tf.random.set_seed(9075)
 IMG_SHAPE = (224, 224, 3)
 SHAPE = (224, 224)
 BATCH_SIZE = 64
-AUTOTUNE = tf.data.experimental.AUTOTUNE
 CLASS_NAMES = np.array([])
+CLASS_TABLE = None
 EPOCHS = 30000
 TRAIN_DATA_PATH = 'images/public_face_1036_224_train/'
 # TRAIN_DATA_PATH = 'images/star224/'
@@ -42,33 +42,12 @@ class SaveBestValCallback(tf.keras.callbacks.Callback):
         verification_path = os.path.join('tfrecord', 'verification.tfrecord')
         ver_dataset = utils.get_ver_data(verification_path, SHAPE)
 
-        first_list, second_list, true_same = ver_dataset[0], ver_dataset[1], np.array(ver_dataset[2])
-        total = len(true_same)
+        dist_list = utils.pair_distances(
+            ver_dataset, lambda images: preprocessing.normalize(self.embedding_model.predict(images), norm='l2'))
 
-        dist_list = []
-        for idx, (img1, img2) in enumerate(zip(first_list, second_list)):
-            h, w, _ = img1.shape
-            result1 = self.embedding_model.predict(np.expand_dims(img1, axis=0))
-            result2 = self.embedding_model.predict(np.expand_dims(img2, axis=0))
-            result1 = preprocessing.normalize(result1, norm='l2')
-            result2 = preprocessing.normalize(result2, norm='l2')
-
-            dist = np.linalg.norm(result1 - result2)
-            dist_list.append(dist)
-
-        thresholds = np.arange(0.1, 3.0, 0.05)
-
-        accs = []
-        for threshold in thresholds:
-            pred_same = np.less(dist_list, threshold)
-            tp = np.sum(np.logical_and(pred_same, true_same))
-            tn = np.sum(np.logical_and(np.logical_not(pred_same), np.logical_not(true_same)))
-            acc = float(tp + tn) / total
-            accs.append(acc)
-        best_index = int(np.argmax(accs))
-
-        val_acc = accs[best_index]
-        val_thr = thresholds[best_index]
+        metrics = utils.roc_metrics(dist_list, ver_dataset.is_same)
+        val_acc = metrics.accuracy
+        val_thr = metrics.threshold
 
         print('\n val_acc: %f, val_thr: %f, current best: %f ' % (val_acc, val_thr, self.best_acc))
         if self.best_acc < val_acc:
@@ -77,24 +56,24 @@ class SaveBestValCallback(tf.keras.callbacks.Callback):
 
 
 def get_label(file_path):
-    parts = tf.strings.split(file_path, '/')
-    one_hot = tf.cast(parts[-2] == CLASS_NAMES, tf.int8)
-    return tf.argmax(one_hot)
+    parts = tf.strings.split(file_path, os.path.sep)
+    return CLASS_TABLE.lookup(parts[-2])
 
 
 def decode_img(img):
     img = tf.image.decode_jpeg(img, channels=3)  # value from 0 ~ 1
     img = tf.image.convert_image_dtype(img, tf.float32)
     img = tf.image.resize(img, [IMG_SHAPE[0], IMG_SHAPE[1]])
-    img = tf.image.random_brightness(img, 0.2)
-    img = tf.image.random_saturation(img, 0.6, 1.6)
-    img = tf.image.random_contrast(img, 0.6, 1.4)
-    img = tf.image.random_flip_left_right(img)
-    img = tf.subtract(img, 0.5)
-    img = tf.multiply(img, 2)
     return img
 
 
+def augment_batch(images, labels):
+    images = pipeline.augment_batch(images, max_value=1.0)
+    images = tf.subtract(images, 0.5)
+    images = tf.multiply(images, 2)
+    return images, labels
+
+
 def process_path(file_path):
     label = get_label(file_path)
     img = tf.io.read_file(file_path)
@@ -102,39 +81,27 @@ def process_path(file_path):
     return img, label
 
 
-def prepare_for_training(ds, cache=False, shuffle_buffer_size=2000):
-    if cache:
-        if isinstance(cache, str):
-            ds = ds.cache(cache)
-        else:
-            ds = ds.cache()
-
-    ds = ds.shuffle(buffer_size=shuffle_buffer_size)
-    ds = ds.repeat()
-    ds = ds.batch(BATCH_SIZE)
-    ds = ds.prefetch(buffer_size=AUTOTUNE)
-
-    return ds
-
-
 def main():
-    global CLASS_NAMES
-
-    train_data_dir = pathlib.Path(TRAIN_DATA_PATH)
-    list_ds = tf.data.Dataset.list_files(str(train_data_dir / '*/*.jpg'))
-    CLASS_NAMES = np.array([item.name for item in train_data_dir.glob('*') if item.name not in [".keep", ".DS_Store"]])
-    test_data_dir = pathlib.Path(TEST_DATA_PATH)
-    test_list_ds = tf.data.Dataset.list_files(str(test_data_dir / '*/*.jpg'))
-    train_image_count = len(list(train_data_dir.glob('*/*.jpg')))
-    test_image_count = len(list(test_data_dir.glob('*/*.jpg')))
+    global CLASS_NAMES, CLASS_TABLE
+
+    train_paths, class_names = pipeline.folder_files(TRAIN_DATA_PATH)
+    test_paths, _ = pipeline.folder_files(TEST_DATA_PATH)
+    CLASS_NAMES = np.array(class_names)
+    # test folders missing from the training tree fall back to class 0, as the old argmax lookup did
+    CLASS_TABLE = pipeline.class_table(class_names, default_value=0)
+    # every path is shuffled each epoch before anything is decoded, no decoded-image shuffle buffer needed
+    list_ds = tf.data.Dataset.from_tensor_slices(train_paths).shuffle(len(train_paths))
+    test_list_ds = tf.data.Dataset.from_tensor_slices(test_paths).shuffle(len(test_paths))
+    train_image_count = len(train_paths)
+    test_image_count = len(test_paths)
     steps_per_epoch = np.ceil(train_image_count / BATCH_SIZE)
     val_steps = np.ceil(test_image_count / BATCH_SIZE)
 
     print('total labels: %d' % len(CLASS_NAMES))
 
-    train_labeled_ds = list_ds.map(process_path, num_parallel_calls=AUTOTUNE)
-    train_ds = prepare_for_training(train_labeled_ds)
-    test_labeled_ds = test_list_ds.map(process_path, num_parallel_calls=AUTOTUNE)
+    train_ds = pipeline.map_pipeline(list_ds, process_path, BATCH_SIZE, repeat=True,
+                                     batch_map_fn=augment_batch)
+    test_ds = pipeline.map_pipeline(test_list_ds, process_path, BATCH_SIZE, batch_map_fn=augment_batch)
 
     base_model = tf.keras.applications.ResNet50V2(input_shape=IMG_SHAPE, include_top=False, weights='imagenet')
     base_model.summary()
@@ -162,11 +129,12 @@ def main():
     model.fit(train_ds,
               epochs=EPOCHS,
               steps_per_epoch=steps_per_epoch,
-              validation_data=test_labeled_ds.batch(BATCH_SIZE),
+              validation_data=test_ds,
               validation_steps=val_steps,
-              callbacks=[SaveBestValCallback(), save_cb, summary_cb])
+              callbacks=[SaveBestValCallback(), save_cb, summary_cb,
+                         pipeline.ThroughputCallback(BATCH_SIZE)])
 
-    loss, accuracy = model.evaluate(test_labeled_ds.batch(BATCH_SIZE), verbose=2)
+    loss, accuracy = model.evaluate(test_ds, verbose=2)
     print("Loss :", loss)
     print("Accuracy :", accuracy)
 
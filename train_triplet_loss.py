@@ -4,18 +4,21 @@ import logging
 import logging.handlers as handlers
 import os
 import random
+import time
 import timeit
 from datetime import datetime
 
 import numpy as np
 import tensorflow as tf
 
+import pipeline
 import utils
 from backend.loss_function import triplet_loss
 from backend.net_builder import NetBuilder, Arch, FinalLayer
 
 MODEL_OUT_PATH = os.path.join('model_out')
 INPUT_SIZE = (112, 112)
+RANDOM_CROP = None  # fraction of each side kept by the random crop, None to disable
 LR_STEPS = [60000, 120000, 160000]
 LR_VAL = [0.01, 0.005, 0.001, 0.0005]
 ACC_LOW_BOUND = 0.85
@@ -157,7 +160,7 @@ def main():
     purge()
     init_log()
 
-    builder = NetBuilder()
+    builder = NetBuilder(INPUT_SIZE)
 
     dataset = get_dataset(args.data_dir)
     total_images_cnt = int(np.sum([len(item) for item in dataset]))
@@ -176,7 +179,8 @@ def main():
 
     image_paths_placeholder = tf.placeholder(tf.string, shape=(None,), name='image_paths')
 
-    triplet_input = triplet_image_process(image_paths_placeholder)
+    triplet_input = triplet_image_process(image_paths_placeholder, builder.input_size)
+    input_ready = pipeline.input_ready(triplet_input)
 
     with tf.name_scope('train'):
         train_net = builder.input_and_train_node(triplet_input, is_training) \
@@ -249,35 +253,48 @@ def main():
         sess.run(tf.global_variables_initializer())
         sess.run(tf.local_variables_initializer())
 
+        state = None
         if args.pretrain != '':
             restore_saver = tf.train.Saver()
             restore_saver.restore(sess,
                                   os.path.join(MODEL_OUT_PATH, args.pretrain))
+            state = utils.load_train_state(os.path.join(MODEL_OUT_PATH, args.pretrain))
 
         have_best = False
         best_accuracy = 0
-        step = 1
+        step = 1 if state is None else state['step']
+        timer = pipeline.StepTimer(extra_phases=('mining',))
         try:
-            for epoch_idx in range(EPOCH):
-                batch_idx = 1
-                buffer_list = sample_buffer(dataset, PAIR_PER_PERSON)
-                if STRATEGY == 'hard':
-                    epoch_size = int(len(buffer_list) / STUDY_SIZE)
+            for epoch_idx in range(0 if state is None else state['epoch_idx'], EPOCH):
+                if state is not None:
+                    # carry on with the rest of the saved epoch's triplets
+                    batch_idx, epoch_size, buffer_list = state['batch_idx'], state['epoch_size'], state['buffer_list']
+                    log('resumed at epoch %d, batch %d/%d, step %d.' % (epoch_idx, batch_idx, epoch_size, step))
+                    state = None
                 else:
-                    epoch_size = int(len(buffer_list) / BATCH_SIZE)
+                    batch_idx = 1
+                    buffer_list = sample_buffer(dataset, PAIR_PER_PERSON)
+                    if STRATEGY == 'hard':
+                        epoch_size = int(len(buffer_list) / STUDY_SIZE)
+                    else:
+                        epoch_size = int(len(buffer_list) / BATCH_SIZE)
                 while batch_idx <= epoch_size:
-                    # Select
-
+                    # Select, hard mining runs the model over the study set and is timed on its own,
+                    # drawing random triplets is only list work and counts as waiting for data
+                    select_start = timeit.default_timer()
                     if STRATEGY == 'hard':
                         sample = hard_batch(sess, train_net, image_paths_placeholder, is_training, buffer_list,
                                             STUDY_SIZE, BATCH_SIZE)
+                        timer.add('mining', timeit.default_timer() - select_start)
                     else:
                         sample = random_batch(buffer_list, BATCH_SIZE)
+                        timer.add('wait', timeit.default_timer() - select_start)
 
                     # Training
                     run_dict = {
                         'train_op': train_op,
-                        'global_step': global_step
+                        'global_step': global_step,
+                        'input_ready': input_ready
                     }
                     feed_dict = {
                         image_paths_placeholder: sample,
@@ -293,21 +310,31 @@ def main():
                     if step % SUMMARY_INTERVAL == 0:
                         run_dict['summary'] = summary_op
 
+                    # the images are decoded inside the run, up to input_ready that is still waiting for data
+                    wall_start = time.time()
                     start_time = timeit.default_timer()
                     results = sess.run(run_dict, feed_dict=feed_dict)
                     duration = timeit.default_timer() - start_time
+                    timer.run(wall_start, results['input_ready'], time.time(), phase='wait')
 
+                    log_start = timeit.default_timer()
                     # print training information
                     if step % SHOW_INFO_INTERVAL == 0:
                         show_info(epoch_idx, batch_idx, epoch_size, step, duration, results)
+                        step_time, step_time_summary = timer.report()
+                        log(step_time)
+                        summary.add_summary(step_time_summary, results['global_step'])
 
                     # save summary
                     if step % SUMMARY_INTERVAL == 0:
                         save_summary(summary, results)
+                    timer.add('log', timeit.default_timer() - log_start)
 
                     # save ckpt files
                     if step % CKPT_INTERVAL == 0 and not have_best:
-                        save_ckpt(step, saver, sess)
+                        save_ckpt(step, saver, sess, {'step': step + 1, 'epoch_idx': epoch_idx,
+                                                      'batch_idx': batch_idx + 1, 'epoch_size': epoch_size,
+                                                      'buffer_list': buffer_list})
 
                     # validate
                     if step % VALIDATE_INTERVAL == 0:
@@ -323,24 +350,18 @@ def main():
             raise err
 
 
-def triplet_image_process(image_paths_placeholder):
+def triplet_image_process(image_paths_placeholder, input_size):
+    # not pipeline.train_pipeline: the triplets are mined from the live model every step and fed as paths,
+    # only the decode and the batch augmentation are shared
     def _parse(image_path):
         file_contents = tf.read_file(image_path)
-        image = tf.image.decode_image(file_contents, channels=3)
-
-        image = tf.image.random_brightness(image, 0.2)
-        image = tf.image.random_saturation(image, 0.6, 1.6)
-        image = tf.image.random_contrast(image, 0.6, 1.4)
-        image = tf.image.random_flip_left_right(image)
-
-        # pylint: disable=no-member
-        image.set_shape((INPUT_SIZE[0], INPUT_SIZE[1], 3))
-        image = utils.tf_pre_process_image(image, INPUT_SIZE)
-
-        return image
+        return pipeline.decode_jpeg(file_contents, input_size, RANDOM_CROP)
 
     with tf.variable_scope('triplet_image_process'):
-        return tf.map_fn(_parse, image_paths_placeholder, dtype=tf.float32)
+        images = tf.map_fn(_parse, image_paths_placeholder, dtype=tf.uint8)
+        images = pipeline.augment_batch(images)
+        images = tf.subtract(images, 127.5)
+        return tf.multiply(images, 0.0078125)
 
 
 def validate(best_accuracy, step, summary_writer, input_layer, net, saver, sess,
@@ -364,11 +385,12 @@ def validate(best_accuracy, step, summary_writer, input_layer, net, saver, sess,
     return best_accuracy
 
 
-def save_ckpt(step, saver, sess):
+def save_ckpt(step, saver, sess, state):
     log('Step: %d, saving ckpt.' % step)
     filename = '{:s}_iter_{:d}.ckpt'.format(MODEL.name, step)
     filename = os.path.join(MODEL_OUT_PATH, filename)
     saver.save(sess, filename)
+    utils.save_train_state(filename, **state)
 
 
 def save_summary(summary, results):
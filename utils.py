@@ -1,7 +1,17 @@
 import datetime
+import glob
+import gzip
+import hashlib
+import json
 import os
 import pickle
+import random
+import re
+import sqlite3
+import time
 import timeit
+import zlib
+from collections import namedtuple
 
 import cv2
 import numpy as np
@@ -9,21 +19,228 @@ import sklearn
 import tensorflow as tf
 from sklearn import preprocessing
 
+IMAGE_SHAPE = (224, 224, 3)
+SHARD_BUFFER_SIZE = 64 * 1024  # read buffer per shard when thousands of identity shards are open
+MAX_OPEN_SHARDS = 256  # RecordIndex closes the least recently opened shard above this
+VER_BATCH_SIZE = 256  # images per embedding call during verification
+EMBEDDING_CACHE_PATH = os.path.join('tfrecord', 'embeddings.sqlite')
+EMBEDDING_CACHE_MB = 2048  # least recently used embeddings are evicted above this size
+
+# every distinct image once, pairs are (images[first_idx[k]], images[second_idx[k]], is_same[k]).
+# uint8 images are normalised when they are embedded.
+VerData = namedtuple('VerData', ['images', 'first_idx', 'second_idx', 'is_same'])
+# pairs closer than threshold are predicted same, tpr / fpr / thresholds cover the whole ROC curve
+RocMetrics = namedtuple('RocMetrics', ['accuracy', 'threshold', 'tp', 'fp', 'fn', 'tn', 'auc', 'eer',
+                                       'tpr', 'fpr', 'thresholds'])
+
+
+def record_files(pattern):
+    # accepts a single record path or a shard glob such as 'train-*-of-*.tfrecord'
+    files = sorted(glob.glob(pattern))
+    if not files:
+        raise FileNotFoundError('no tfrecord matches %s' % pattern)
+    return files
+
+
+def record_iterator(pattern):
+    for path in record_files(pattern):
+        # yield from tf.python_io.tf_record_iterator(path=path)
+        yield from tf.compat.v1.io.tf_record_iterator(path=path, options=record_compression(path))
+
+
+def record_dataset(pattern, buffer_size=None):
+    files = record_files(pattern)
+    return tf.data.TFRecordDataset(files, compression_type=common_compression(files), buffer_size=buffer_size)
+
+
+def common_compression(files):
+    compressions = set(record_compression(path) for path in files)
+    if len(compressions) > 1:
+        raise ValueError('records mix compression types %s' % sorted(compressions))
+    return compressions.pop()
+
+
+def identity_dataset(pattern, class_weights=None, images_per_identity=1, seed=None):
+    # for shards built with layout='identity': every draw picks a label by its class weight and reads
+    # images_per_identity of its records through the '<record>.index' sidecars, so batches of
+    # P * images_per_identity give P identities x K images without a shuffle buffer. nothing but the
+    # index table is held between draws and at most MAX_OPEN_SHARDS shards are open at a time.
+    index = RecordIndex(pattern)
+    order = np.argsort(index.labels, kind='mergesort')
+    labels, starts = np.unique(index.labels[order], return_index=True)
+    records = np.split(order, starts[1:])
+    class_weights = class_weights or {}
+    weights = np.array([class_weights.get(label, 1.0) for label in labels], dtype=np.float64)
+    weights /= np.sum(weights)
+
+    def generator():
+        rng = np.random.RandomState(seed)
+        while True:
+            label_records = records[rng.choice(len(labels), p=weights)]
+            picked = rng.choice(label_records, images_per_identity,
+                                replace=len(label_records) < images_per_identity)
+            for k in picked:
+                yield index.read(k)
+
+    return tf.data.Dataset.from_generator(generator, output_types=tf.string, output_shapes=tf.TensorShape([]))
+
+
+def record_header(path):
+    header_path = path + '.json'
+    if not os.path.exists(header_path):
+        return {}
+    with open(header_path) as f:
+        return json.load(f)
+
+
+def record_compression(path):
+    header = record_header(path)
+    if 'compression' in header:
+        return header['compression']
+    # no header (older records): sniff gzip/zlib by trying to inflate the first bytes
+    with open(path, 'rb') as f:
+        head = f.read(64)
+    if not head:
+        return ''
+    for compression, wbits in (('GZIP', 16 + zlib.MAX_WBITS), ('ZLIB', zlib.MAX_WBITS)):
+        try:
+            zlib.decompressobj(wbits).decompress(head)
+            return compression
+        except zlib.error:
+            pass
+    return ''
+
+
+class RecordIndex:
+    # random access into tfrecord shards through the '<record>.index' sidecars,
+    # rows are (shard, offset, length, label) and k counts across all shards in order
+    def __init__(self, pattern):
+        self.files = record_files(pattern)
+        tables = []
+        for shard, path in enumerate(self.files):
+            table = np.load(path + '.index')
+            tables.append(np.hstack((np.full((len(table), 1), shard, dtype=np.int64), table)))
+        self.table = np.vstack(tables)
+        self.handles = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def labels(self):
+        return self.table[:, 3]
+
+    def label_records(self, label):
+        return np.flatnonzero(self.table[:, 3] == label)
+
+    def read(self, k):
+        shard, offset, length, _ = self.table[k]
+        f = self.open(shard)
+        f.seek(offset + 12)  # skip length and its crc
+        return f.read(length)
+
+    def read_label(self, label):
+        for k in self.label_records(label):
+            yield self.read(k)
+
+    def split(self, num_workers, worker):
+        # exact contiguous slice for one of num_workers readers, no prefix is read
+        bounds = np.linspace(0, len(self), num_workers + 1).astype(np.int64)
+        return range(bounds[worker], bounds[worker + 1])
+
+    def dataset(self, ks):
+        ks = list(ks)
+        return tf.data.Dataset.from_generator(lambda: (self.read(k) for k in ks),
+                                              output_types=tf.string,
+                                              output_shapes=tf.TensorShape([]))
+
+    def open(self, shard):
+        if shard not in self.handles:
+            if len(self.handles) >= MAX_OPEN_SHARDS:
+                self.handles.pop(next(iter(self.handles))).close()
+            path = self.files[shard]
+            compression = record_compression(path)
+            if compression == '':
+                self.handles[shard] = open(path, 'rb')
+            elif compression == 'GZIP':
+                # gzip seeks by inflating up to the offset, still no record parsing
+                self.handles[shard] = gzip.open(path, 'rb')
+            else:
+                raise ValueError('random access needs uncompressed or GZIP records: %s' % path)
+        return self.handles[shard]
+
+    def close(self):
+        for f in self.handles.values():
+            f.close()
+        self.handles = {}
+
+
+def train_dataset(pattern, record_format='jpeg'):
+    if record_format == 'npy':
+        return npy_dataset(pattern).map(augment_function)
+    parse_fn = parse_raw_function if record_format == 'raw' else parse_function
+    return record_dataset(pattern).map(parse_fn)
+
 
 def parse_function(example_proto):
+    return augment_function(*decode_function(example_proto))
+
+
+def parse_raw_function(example_proto):
+    return augment_function(*decode_raw_function(example_proto))
+
+
+def decode_function(example_proto):
+    features = parse_example(example_proto)
+    img = tf.image.decode_jpeg(features['image_raw'], dct_method='INTEGER_ACCURATE')
+    img = tf.reshape(img, IMAGE_SHAPE)
+    return img, tf.cast(features['label'], tf.int64)
+
+
+def decode_raw_function(example_proto):
+    # records built with record_format='raw' already hold resized uint8 pixels
+    features = parse_example(example_proto)
+    img = tf.io.decode_raw(features['image_raw'], tf.uint8)
+    img = tf.reshape(img, IMAGE_SHAPE)
+    return img, tf.cast(features['label'], tf.int64)
+
+
+def parse_example(example_proto):
     features = {'image_raw': tf.io.FixedLenFeature([], tf.string),
                 'label': tf.io.FixedLenFeature([], tf.int64)}
-    features = tf.io.parse_single_example(example_proto, features)
-    img = tf.image.decode_jpeg(features['image_raw'], dct_method='INTEGER_ACCURATE')
+    return tf.io.parse_single_example(example_proto, features)
+
+
+def augment_function(img, label):
     img = tf.image.random_brightness(img, 0.2)
     img = tf.image.random_saturation(img, 0.6, 1.6)
     img = tf.image.random_contrast(img, 0.6, 1.4)
     img = tf.image.random_flip_left_right(img)
-    img = tf_pre_process_image(img, (224, 224))
-    label = tf.cast(features['label'], tf.int64)
+    img = tf_pre_process_image(img, img.shape.as_list()[:2])
+    label = tf.cast(label, tf.int64)
     return img, label
 
 
+def npy_dataset(pattern, num_parallel_calls=tf.data.experimental.AUTOTUNE):
+    # record_format='npy' shards, images are memory-mapped and never fully loaded. the dataset runs over
+    # (shard, row) indices and rows are copied out of the memmaps by a parallel map, not one python generator
+    shards = record_files(pattern)
+    images = [np.load(shard, mmap_mode='r') for shard in shards]
+    labels = np.concatenate([np.load(shard + '.labels') for shard in shards])
+    shard_idx = np.concatenate([np.full(len(rows), i, dtype=np.int64) for i, rows in enumerate(images)])
+    row_idx = np.concatenate([np.arange(len(rows), dtype=np.int64) for rows in images])
+
+    def read(shard, row):
+        return np.array(images[shard][row])
+
+    def load(shard, row, label):
+        img = tf.numpy_function(read, [shard, row], tf.uint8)
+        return tf.reshape(img, IMAGE_SHAPE), label
+
+    return tf.data.Dataset.from_tensor_slices((shard_idx, row_idx, labels)).map(load,
+                                                                                num_parallel_calls=num_parallel_calls)
+
+
 def tf_pre_process_image(img, shape):
     img = tf.reshape(img, shape=(shape[0], shape[1], 3))
     # r, g, b = tf.split(img, num_or_size_splits=3, axis=-1)
@@ -43,109 +260,246 @@ def pre_process_image(img, shape):
 
 
 def get_ver_data(record_path, shape, preprocessing=True):
-    # record_iterator = tf.python_io.tf_record_iterator(path=record_path)
-    record_iterator = tf.compat.v1.io.tf_record_iterator(path=record_path)
-    first_list = []
-    second_list = []
+    # preprocessed sets are cached as uint8 next to the record, memory-mapped on load and
+    # normalised batch by batch in embed_images
+    if not preprocessing:
+        return decode_ver_data(record_path)
+    images_path, pairs_path = ver_cache_paths(record_path, shape)
+    if not (os.path.exists(images_path) and os.path.exists(pairs_path)):
+        data_set = decode_ver_data(record_path, shape)
+        pairs = np.stack([data_set.first_idx, data_set.second_idx, data_set.is_same.astype(np.int64)], axis=1)
+        for path, array in ((images_path, np.stack(data_set.images)), (pairs_path, pairs)):
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(path + '.tmp', path)
+    pairs = np.load(pairs_path)
+    return VerData(np.load(images_path, mmap_mode='r'), pairs[:, 0], pairs[:, 1], pairs[:, 2].astype(bool))
+
+
+def ver_cache_paths(record_path, shape):
+    # keyed by the path, size and mtime of every file the record (or shard glob) resolves to and by the target
+    # shape, so a cache hit costs one stat per file. caches of older versions of the record are removed
+    files = record_files(record_path)
+    stats = [(os.path.abspath(path), os.stat(path)) for path in files]
+    source = ';'.join('%s:%d:%d' % (path, stat.st_size, stat.st_mtime_ns) for path, stat in stats)
+    name = re.sub(r'[^\w.-]', '_', os.path.splitext(os.path.basename(record_path))[0])
+    prefix = os.path.join(os.path.dirname(files[0]), '%s.%dx%d.' % (name, shape[0], shape[1]))
+    cache = prefix + hashlib.sha1(source.encode('utf8')).hexdigest()[:16]
+    for stale in glob.glob(glob.escape(prefix) + '*'):
+        if not stale.startswith(cache):
+            os.remove(stale)
+    return cache + '.images.npy', cache + '.pairs.npy'
+
+
+def decode_ver_data(record_path, shape=None):
+    # an image shared by several pairs is decoded once, pairs refer to it by index
+    index = {}
+    images = []
+    first_idx = []
+    second_idx = []
     is_same_list = []
-    for record in record_iterator:
+
+    def image_index(image_string):
+        key = hashlib.sha1(image_string).digest()
+        if key not in index:
+            img = cv2.imdecode(np.frombuffer(image_string, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if shape is not None:
+                img = cv2.resize(img, shape)
+            index[key] = len(images)
+            images.append(img)
+        return index[key]
+
+    records = record_iterator(record_path)
+    for record in records:
         example = tf.train.Example()
         example.ParseFromString(record)
-        image_string = example.features.feature['image_first'].bytes_list.value[0]
-        img = np.fromstring(image_string, dtype=np.uint8)
-        img_first = cv2.imdecode(img, cv2.IMREAD_COLOR)
-        if preprocessing:
-            img_first = pre_process_image(img_first, shape)
-        first_list.append(img_first)
-
-        image_string = example.features.feature['image_second'].bytes_list.value[0]
-        img = np.fromstring(image_string, dtype=np.uint8)
-        img_second = cv2.imdecode(img, cv2.IMREAD_COLOR)
-        if preprocessing:
-            img_second = pre_process_image(img_second, shape)
-        second_list.append(img_second)
-
-        is_same = example.features.feature['is_same'].int64_list.value[0]
-        is_same_list.append(is_same)
-
-    return [first_list, second_list, is_same_list]
-
-
-def ver_tfrecord(data_set, embedding_fn, verbose=False):
-    first_list, second_list, true_same = data_set[0], data_set[1], np.array(data_set[2])
-    total = len(true_same)
-    same = int(np.sum(true_same))
-    diff = total - same
+        feature = example.features.feature
+        if 'first_idx' in feature:
+            # 'pair_index' records: the pairs come first as index arrays, then every image once in index order
+            pairs = VerData(images, np.array(feature['first_idx'].int64_list.value, dtype=np.int64),
+                            np.array(feature['second_idx'].int64_list.value, dtype=np.int64),
+                            np.array(feature['is_same'].int64_list.value, dtype=bool))
+            for image_record in records:
+                example.ParseFromString(image_record)
+                image_string = example.features.feature['image_raw'].bytes_list.value[0]
+                img = cv2.imdecode(np.frombuffer(image_string, dtype=np.uint8), cv2.IMREAD_COLOR)
+                images.append(img if shape is None else cv2.resize(img, shape))
+            return pairs
+        first_idx.append(image_index(feature['image_first'].bytes_list.value[0]))
+        second_idx.append(image_index(feature['image_second'].bytes_list.value[0]))
+        is_same_list.append(feature['is_same'].int64_list.value[0])
+
+    return VerData(images, np.array(first_idx, dtype=np.int64), np.array(second_idx, dtype=np.int64),
+                   np.array(is_same_list, dtype=bool))
+
+
+def embed_images(images, embedding_fn, batch_size=VER_BATCH_SIZE, cache=None):
+    # embedding_fn maps a normalised [B, H, W, 3] batch to [B, D] embeddings,
+    # with an EmbeddingCache only the images it does not hold yet are passed to embedding_fn
+    if cache is not None:
+        return cache.embed(images, lambda misses: embed_images(misses, embedding_fn, batch_size))
+    embeddings = []
+    for start in range(0, len(images), batch_size):
+        batch = np.asarray(images[start:start + batch_size])
+        if batch.dtype == np.uint8:  # cached sets stay uint8 until they are embedded
+            batch = pre_process_batch(batch)
+        embeddings.append(embedding_fn(batch))
+    return np.concatenate(embeddings)
+
+
+def model_hash(*paths):
+    # content hash of model files, directories are walked in sorted order
+    sha1 = hashlib.sha1()
+    for path in paths:
+        files = [path] if os.path.isfile(path) else \
+            sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        for name in files:
+            sha1.update(os.path.relpath(name, path).encode('utf8'))
+            with open(name, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class EmbeddingCache:
+    # on-disk embeddings keyed by (model, preprocessing config, image content hash), so evaluating the same
+    # checkpoint again only runs the model on images it has not seen. the model key is model_hash() of the
+    # checkpoint files, config is anything else that changes the embedding (input size, normalisation, ...)
+    def __init__(self, model_key, config=None, path=EMBEDDING_CACHE_PATH, max_mb=EMBEDDING_CACHE_MB):
+        config = dict(config or {}, normalisation='(x - 127.5) * 0.0078125')
+        self.key = hashlib.sha1((model_key + json.dumps(config, sort_keys=True)).encode('utf8')).hexdigest()
+        self.max_bytes = max_mb * 1024 * 1024
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS embeddings (model TEXT, image BLOB, embedding BLOB, '
+                        'used REAL, PRIMARY KEY (model, image))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)')
+
+    def embed(self, images, embed_fn):
+        # embed_fn embeds a list of images the cache misses, hits are refreshed for the LRU
+        keys = [self.image_key(img) for img in images]
+        found = {}
+        for start in range(0, len(keys), 500):  # stay below sqlite's bound parameter limit
+            chunk = keys[start:start + 500]
+            found.update(self.db.execute('SELECT image, embedding FROM embeddings WHERE model = ? AND image IN (%s)' %
+                                         ','.join('?' * len(chunk)), [self.key] + chunk).fetchall())
+        misses = [i for i, key in enumerate(keys) if key not in found]
+        now = time.time()
+        with self.db:
+            self.db.executemany('UPDATE embeddings SET used = ? WHERE model = ? AND image = ?',
+                                [(now, self.key, key) for key in found])
+            if misses:
+                computed = np.asarray(embed_fn([images[i] for i in misses]), dtype=np.float32)
+                for i, embedding in zip(misses, computed):
+                    found[keys[i]] = embedding.tobytes()
+                self.db.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)',
+                                    [(self.key, keys[i], found[keys[i]], now) for i in misses])
+        print('embedding cache: %d hits, %d misses' % (len(keys) - len(misses), len(misses)))
+        if misses:
+            self.evict()
+        return np.stack([np.frombuffer(found[key], dtype=np.float32) for key in keys])
+
+    @staticmethod
+    def image_key(img):
+        img = np.ascontiguousarray(img)
+        sha1 = hashlib.sha1(('%s%s' % (img.dtype, img.shape)).encode('utf8'))
+        sha1.update(img)
+        return sha1.digest()
+
+    def evict(self):
+        size, = self.db.execute('SELECT COALESCE(SUM(LENGTH(embedding) + LENGTH(image)), 0) FROM embeddings').fetchone()
+        if size <= self.max_bytes:
+            return
+        with self.db:
+            cursor = self.db.execute('SELECT rowid, LENGTH(embedding) + LENGTH(image) FROM embeddings ORDER BY used')
+            stale = []
+            for rowid, row_size in cursor:
+                if size <= self.max_bytes:
+                    break
+                stale.append((rowid,))
+                size -= row_size
+            self.db.executemany('DELETE FROM embeddings WHERE rowid = ?', stale)
+        print('embedding cache: evicted %d embeddings' % len(stale))
+
+    def close(self):
+        self.db.close()
+
+
+def pair_distances(data_set, embedding_fn, batch_size=VER_BATCH_SIZE, cache=None):
+    start = timeit.default_timer()
+    embeddings = embed_images(data_set.images, embedding_fn, batch_size, cache)
+    dist = np.linalg.norm(embeddings[data_set.first_idx] - embeddings[data_set.second_idx], axis=1)
+    cost = timeit.default_timer() - start
+    print('verification: %d pairs over %d images in %.2f sec, %.1f pairs/sec' %
+          (len(dist), len(data_set.images), cost, len(dist) / max(cost, 1e-9)))
+    return dist
+
+
+def roc_metrics(dist, is_same):
+    # one sort plus cumulative counts, every distinct distance is a candidate threshold
+    dist = np.asarray(dist, dtype=np.float64)
+    is_same = np.asarray(is_same, dtype=bool)
+    if len(dist) == 0:
+        raise ValueError('roc_metrics needs at least one pair')
+    order = np.argsort(dist, kind='mergesort')
+    dist, is_same = dist[order], is_same[order]
+    same = int(np.sum(is_same))
+    diff = len(dist) - same
+
+    # cut k predicts the first k runs of equal distances as same
+    last = np.r_[np.flatnonzero(np.diff(dist)), len(dist) - 1]
+    tp = np.r_[0, np.cumsum(is_same)[last]]
+    fp = np.r_[0, np.cumsum(~is_same)[last]]
+    fn = same - tp
+    tn = diff - fp
+    unique = dist[last]
+    # thresholds[k] sits between the k-th and (k + 1)-th distinct distance, np.less(dist, thresholds[k]) gives cut k.
+    # a midpoint that rounds onto the lower distance (adjacent floats) falls back to the upper one
+    upper = np.r_[unique[1:], np.nextafter(unique[-1], np.inf)]
+    middle = unique + (upper - unique) / 2
+    thresholds = np.r_[unique[0], np.where(middle > unique, middle, upper)]
+
+    accs = (tp + tn) / float(len(dist))
+    tpr = tp / float(max(same, 1))
+    fpr = fp / float(max(diff, 1))
+    auc = float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+    fnr = 1 - tpr
+    eer_index = int(np.argmin(np.abs(fnr - fpr)))
+    eer = float(fnr[eer_index] + fpr[eer_index]) / 2
+
+    best = int(np.argmax(accs))
+    return RocMetrics(float(accs[best]), float(thresholds[best]), int(tp[best]), int(fp[best]), int(fn[best]),
+                      int(tn[best]), auc, eer, tpr, fpr, thresholds)
+
+
+def ver_tfrecord(data_set, embedding_fn, verbose=False, batch_size=VER_BATCH_SIZE, cache=None):
+    true_same = np.asarray(data_set.is_same)
     if verbose:
-        print('samples: %d, same: %d, diff: %d' % (total, same, diff))
+        same = int(np.sum(true_same))
+        print('samples: %d, same: %d, diff: %d' % (len(true_same), same, len(true_same) - same))
 
-    dist_list = []
-    start = timeit.default_timer()
-    for idx, (first, second) in enumerate(zip(first_list, second_list)):
-        result1, result2 = embedding_fn(first, second)
+    dist_list = pair_distances(data_set, embedding_fn, batch_size, cache)
 
-        dist = np.linalg.norm(result1 - result2)
-        dist_list.append(dist)
-        if (idx % 1000 == 0) & verbose:
-            print('complete %d pairs' % idx)
-    if verbose:
-        print('cost_times: %.2f sec' % (timeit.default_timer() - start))
-
-    thresholds = np.arange(0.1, 3.0, 0.05)
-
-    accs = []
-    tps = []
-    fps = []
-    fns = []
-    tns = []
-    for threshold in thresholds:
-        pred_same = np.less(dist_list, threshold)
-        tp = np.sum(np.logical_and(pred_same, true_same))
-        tn = np.sum(np.logical_and(np.logical_not(pred_same), np.logical_not(true_same)))
-        fp = diff - tn
-        fn = same - tp
-        acc = float(tp + tn) / total
-        accs.append(acc)
-        tps.append(int(tp))
-        tns.append(int(tn))
-        fps.append(int(fp))
-        fns.append(int(fn))
-    print('thresholds:', ", ".join("%.2f" % f for f in thresholds))
-    print('accs:', ", ".join("%.2f" % f for f in accs))
-    tpr = [0 if (tp + fn == 0) else float(tp) / float(tp + fn) for tp, fn in zip(tps, fns)]
-    fpr = [0 if (fp + tn == 0) else float(fp) / float(fp + tn) for fp, tn in zip(fps, tns)]
-    best_index = int(np.argmax(accs))
-
-    print('tps:', ", ".join("%.2f" % f for f in tps))
-    print('tns:', ", ".join("%.2f" % f for f in tns))
-    print('fps:', ", ".join("%.2f" % f for f in fps))
-    print('fns:', ", ".join("%.2f" % f for f in fns))
-
-    return accs[best_index], thresholds[best_index], tps[best_index], fps[best_index], fns[best_index], tns[
-        best_index], tpr, fpr
-
-
-def ver_test(data_set, sess, l2_embedding_tensor, input_placeholder):
-    first_list, second_list, true_same = data_set[0], data_set[1], np.array(data_set[2])
-
-    dist_list = []
-    for first, second in zip(first_list, second_list):
-        vector_pair = sess.run(l2_embedding_tensor, feed_dict={input_placeholder: np.stack((first, second), axis=0)})
-        dist = np.linalg.norm(vector_pair[0] - vector_pair[1])
-        dist_list.append(dist)
-
-    thresholds = np.arange(0.1, 3.0, 0.1)
-
-    accs = []
-    for threshold in thresholds:
-        pred_same = np.less(dist_list, threshold)
-        tp = np.sum(np.logical_and(pred_same, true_same))
-        tn = np.sum(np.logical_and(np.logical_not(pred_same), np.logical_not(true_same)))
-        acc = float(tp + tn) / len(first_list)
-        accs.append(acc)
-    best_threshold_index = int(np.argmax(accs))
-
-    return accs[best_threshold_index], thresholds[best_threshold_index]
+    metrics = roc_metrics(dist_list, true_same)
+    print('auc: %.4f, eer: %.4f, best acc: %.4f at thr %.4f (tp %d, fp %d, fn %d, tn %d)' %
+          (metrics.auc, metrics.eer, metrics.accuracy, metrics.threshold,
+           metrics.tp, metrics.fp, metrics.fn, metrics.tn))
+
+    return metrics.accuracy, metrics.threshold, metrics.tp, metrics.fp, metrics.fn, metrics.tn, \
+        metrics.tpr, metrics.fpr
+
+
+def ver_test(data_set, sess, l2_embedding_tensor, input_placeholder, feed_dict=None, batch_size=VER_BATCH_SIZE):
+    def embedding_fn(images):
+        batch_feed = dict(feed_dict or {})
+        batch_feed[input_placeholder] = images
+        return sess.run(l2_embedding_tensor, feed_dict=batch_feed)
+
+    dist_list = pair_distances(data_set, embedding_fn, batch_size)
+
+    metrics = roc_metrics(dist_list, data_set.is_same)
+    print('auc: %.4f, eer: %.4f' % (metrics.auc, metrics.eer))
+
+    return metrics.accuracy, metrics.threshold
 
 
 def plot_roc(fpr, tpr):
@@ -165,38 +519,67 @@ def plot_roc(fpr, tpr):
 
 
 def load_bin(bin_path, input_size):
-    import mxnet as mx
-
-    bins, issame_list = pickle.load(open(bin_path, 'rb'), encoding='bytes')
-    first_imgs = np.empty((len(issame_list) * 2, input_size[0], input_size[1], 3))
-    second_imgs = np.empty((len(issame_list) * 2, input_size[0], input_size[1], 3))
-
-    for i in range(len(issame_list) * 2):
-        _bin = bins[i]
-        img = mx.image.imdecode(_bin).asnumpy()  # BGR
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img = cv2.resize(img, input_size)
-        img = img - 127.5
-        img = img * 0.0078125
-        for flip in [0, 1]:
-            if flip == 1:
-                img = np.fliplr(img)
-            if i % 2 == 0:
-                first_imgs[i + flip, ...] = img
-            else:
-                second_imgs[i - 1 + flip, ...] = img
-        i += 1
-        if i % 1000 == 0:
-            print('loading bin', i)
-
-    return first_imgs, second_imgs, np.repeat(issame_list, 2)
-
-
-def test_tfrecord(tfrecord, embedding_fn, shape, is_plot=False, verbose=False):
+    images, pairs = load_bin_arrays(bin_path)
+    if images.shape[1:3] != (input_size[1], input_size[0]):
+        images = np.stack([cv2.resize(img, input_size) for img in images])
+    # every pair is evaluated as is and horizontally flipped, like the insightface loader
+    count = len(images)
+    images = np.concatenate([images, images[:, :, ::-1]])
+    first_idx = np.stack([pairs[:, 0], pairs[:, 0] + count], axis=1).ravel()
+    second_idx = np.stack([pairs[:, 1], pairs[:, 1] + count], axis=1).ravel()
+
+    return VerData(images, first_idx, second_idx, np.repeat(pairs[:, 2].astype(bool), 2))
+
+
+def load_bin_arrays(bin_path):
+    # '<name>.npy' uint8 images and '<name>.pairs.npy' (first_idx, second_idx, is_same) rows,
+    # converted from the insightface .bin on first use and memory-mapped afterwards
+    images_path = os.path.splitext(bin_path)[0] + '.npy'
+    pairs_path = os.path.splitext(bin_path)[0] + '.pairs.npy'
+    if not (os.path.exists(images_path) and os.path.exists(pairs_path)):
+        convert_bin(bin_path, images_path, pairs_path)
+    return np.load(images_path, mmap_mode='r'), np.load(pairs_path)
+
+
+def convert_bin(bin_path, images_path, pairs_path):
+    with open(bin_path, 'rb') as f:
+        bins, issame_list = pickle.load(f, encoding='bytes')
+    count = len(issame_list) * 2
+
+    images = None
+    for i in range(count):
+        # cv2 decodes to BGR, the same order the old mxnet decode + BGR2RGB swap produced
+        img = cv2.imdecode(np.frombuffer(bins[i], dtype=np.uint8), cv2.IMREAD_COLOR)
+        if images is None:
+            images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8,
+                                               shape=(count,) + img.shape)
+        if img.shape != images.shape[1:]:
+            img = cv2.resize(img, (images.shape[2], images.shape[1]))
+        images[i] = img
+        if (i + 1) % 1000 == 0:
+            print('converting bin', i + 1)
+    images.flush()
+    del images
+    os.replace(images_path + '.tmp', images_path)
+
+    pairs = np.stack([np.arange(0, count, 2), np.arange(1, count, 2), np.array(issame_list, dtype=np.int64)], axis=1)
+    np.save(pairs_path, pairs)
+    print('%s converted to %s and %s' % (bin_path, images_path, pairs_path))
+
+
+def pre_process_batch(images):
+    images = np.array(images, dtype=np.float32)
+    images -= 127.5
+    images *= 0.0078125
+    return images
+
+
+def test_tfrecord(tfrecord, embedding_fn, shape, is_plot=False, verbose=False, cache=None):
     verification_path = os.path.join('tfrecord', tfrecord)
     ver_dataset = get_ver_data(verification_path, shape)
 
-    val_acc, val_thr, tp, fp, fn, tn, tpr, fpr = ver_tfrecord(ver_dataset, embedding_fn, verbose=verbose)
+    val_acc, val_thr, tp, fp, fn, tn, tpr, fpr = ver_tfrecord(ver_dataset, embedding_fn, verbose=verbose,
+                                                              cache=cache)
     print('test accuracy is: %.3f, thr: %.2f, prec: %.3f, rec: %.3f.' %
           (val_acc, val_thr, float(tp) / (tp + fp), float(tp) / (tp + fn)))
 
@@ -204,12 +587,30 @@ def test_tfrecord(tfrecord, embedding_fn, shape, is_plot=False, verbose=False):
         plot_roc(fpr, tpr)
 
 
-def test_lfw(path, embedding_fn, shape, is_plot=False):
+def test_lfw(path, embedding_fn, shape, is_plot=False, cache=None):
     ver_dataset = load_bin(path, shape)
 
-    val_acc, val_thr, tp, fp, fn, tn, tpr, fpr = ver_tfrecord(ver_dataset, embedding_fn)
+    val_acc, val_thr, tp, fp, fn, tn, tpr, fpr = ver_tfrecord(ver_dataset, embedding_fn, cache=cache)
     print('test accuracy is: %.3f, thr: %.2f, prec: %.3f, rec: %.3f.' %
           (val_acc, val_thr, float(tp) / (tp + fp), float(tp) / (tp + fn)))
 
     if is_plot:
         plot_roc(fpr, tpr)
+
+
+def save_train_state(ckpt_path, **state):
+    # sampler position plus python/numpy RNG state next to a checkpoint, so a restart resumes mid-epoch
+    state.update(random=random.getstate(), numpy=np.random.get_state())
+    with open(ckpt_path + '.state', 'wb') as f:
+        pickle.dump(state, f)
+
+
+def load_train_state(ckpt_path):
+    # None for checkpoints saved without a state, restores the RNGs as a side effect
+    if not os.path.exists(ckpt_path + '.state'):
+        return None
+    with open(ckpt_path + '.state', 'rb') as f:
+        state = pickle.load(f)
+    random.setstate(state.pop('random'))
+    np.random.set_state(state.pop('numpy'))
+    return state